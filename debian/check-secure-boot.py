@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Predict whether EFI binaries pass Secure Boot with the keys enrolled in
+# a VARS image, without booting a VM. With --shim, the binaries are
+# checked the way that shim checks the binaries it loads, like GRUB.
+#
+# Usage: PYTHONPATH=./debian/python python3 debian/check-secure-boot.py --help
+
+import argparse
+import json
+import sys
+
+from UEFI.SecureBoot import SecureBootPolicy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check EFI binaries against the db and dbx of a VARS '
+                    'image.'
+    )
+    parser.add_argument('vars', help='VARS image, like OVMF_VARS_4M.ms.fd')
+    parser.add_argument('binaries', nargs='+', help='EFI binaries to check')
+    parser.add_argument(
+        '--dbx', action='append', default=[],
+        help='signed dbx update, like debian/DBXUpdate-*.bin, to add to the '
+             'dbx of the image, may be given more than once',
+    )
+    parser.add_argument(
+        '--shim', help='check the binaries as loaded by this shim',
+    )
+    parser.add_argument(
+        '-j', '--json', action='store_true', help='print JSON',
+    )
+    args = parser.parse_args()
+
+    policy = SecureBootPolicy.from_vars(args.vars, args.dbx)
+    if args.shim:
+        policy = policy.for_shim(args.shim)
+
+    results = []
+    for path in args.binaries:
+        (accepted, reason) = policy.check(path)
+        results.append({'path': path, 'accepted': accepted, 'reason': reason})
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        for r in results:
+            sys.stdout.write(
+                "%s: %s (%s)\n" % (
+                    r['path'], 'accepted' if r['accepted'] else 'rejected',
+                    r['reason'],
+                )
+            )
+    sys.exit(0 if all(r['accepted'] for r in results) else 1)
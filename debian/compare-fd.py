@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Compare firmware images between two builds: which regions changed or
+# moved, how the volumes grew, and whether any of them is running out of
+# space. Takes two .fd files, or two directories whose .fd files are
+# compared by name.
+#
+# Usage: PYTHONPATH=./debian/python python3 debian/compare-fd.py --help
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+from UEFI.FirmwareVolume import (
+    EFI_FIRMWARE_FILE_SYSTEM2_GUID, EFI_FIRMWARE_FILE_SYSTEM3_GUID,
+    FirmwareImage
+)
+
+ChunkSize = 4096
+
+
+def chunk_hashes(m):
+    '''
+    Maps the hash of every ChunkSize aligned chunk of m to the offsets it
+    is found at.
+    '''
+    index = {}
+    for offset in range(0, len(m), ChunkSize):
+        digest = hashlib.blake2b(
+            m[offset:offset + ChunkSize], digest_size=16
+        ).digest()
+        index.setdefault(digest, []).append(offset)
+    return index
+
+
+def differing_bytes(a, b):
+    n = min(len(a), len(b))
+    x = int.from_bytes(a[:n], 'little') ^ int.from_bytes(b[:n], 'little')
+    return n - x.to_bytes(n, 'little').count(0) + abs(len(a) - len(b))
+
+
+def delta(old, new):
+    '''
+    Splits new into chunks and classifies each one as unchanged (same
+    content at the same offset in old), moved (found elsewhere in old) or
+    changed. Returns the coalesced changed ranges as (start, end, bytes
+    that differ from old at the same offset) and the number of moved
+    bytes.
+    '''
+    changed = []
+    moved = 0
+    index = None
+    for offset in range(0, len(new), ChunkSize):
+        chunk = new[offset:offset + ChunkSize]
+        if old[offset:offset + ChunkSize] == chunk:
+            continue
+        if index is None:
+            index = chunk_hashes(old)
+        digest = hashlib.blake2b(chunk, digest_size=16).digest()
+        # Filler, like erased flash, is found everywhere: not a move
+        filler = chunk.count(chunk[:1]) == len(chunk)
+        if digest in index and not filler:
+            moved += len(chunk)
+            continue
+        if changed and changed[-1][1] == offset:
+            changed[-1][1] = offset + len(chunk)
+        else:
+            changed.append([offset, offset + len(chunk)])
+    return (
+        [
+            (start, end, differing_bytes(old[start:end], new[start:end]))
+            for (start, end) in changed
+        ],
+        moved,
+    )
+
+
+def volumes(image):
+    '''
+    Maps a stable key for each FFS volume, including nested ones, to the
+    volume. Other volumes, like variable stores, have no meaningful free
+    space.
+    '''
+    result = {}
+    pending = [(v, '') for v in image.volumes]
+    while pending:
+        (volume, parent) = pending.pop(0)
+        name = str(volume.name or volume.filesystem)
+        key = f'{parent}/{name}'
+        n = 1
+        while key in result:
+            n += 1
+            key = f'{parent}/{name}#{n}'
+        if volume.filesystem in (EFI_FIRMWARE_FILE_SYSTEM2_GUID,
+                                 EFI_FIRMWARE_FILE_SYSTEM3_GUID):
+            result[key] = volume
+        for f in volume.files:
+            pending.extend((nested, key) for nested in f.volumes())
+    return result
+
+
+def compare(old_path, new_path):
+    with open(old_path, 'rb') as fold, open(new_path, 'rb') as fnew:
+        old = mmap.mmap(fold.fileno(), 0, access=mmap.ACCESS_READ)
+        new = mmap.mmap(fnew.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (changed, moved) = delta(old, new)
+        finally:
+            old.close()
+            new.close()
+
+    with FirmwareImage(old_path) as old_image, \
+            FirmwareImage(new_path) as new_image:
+        old_volumes = volumes(old_image)
+        new_volumes = volumes(new_image)
+        volume_report = []
+        for (key, v) in new_volumes.items():
+            # Pad files are space that can be reclaimed
+            entry = {
+                'volume': key,
+                'size': v.size,
+                'used': v.used(),
+                'free': v.free + v.padding(),
+            }
+            if key in old_volumes:
+                entry['old_used'] = old_volumes[key].used()
+            volume_report.append(entry)
+
+    return {
+        'old': old_path,
+        'new': new_path,
+        'old_size': os.path.getsize(old_path),
+        'new_size': os.path.getsize(new_path),
+        'changed': [
+            {'start': start, 'end': end, 'differing': differing}
+            for (start, end, differing) in changed
+        ],
+        'moved': moved,
+        'volumes': volume_report,
+    }
+
+
+def pairs(old, new):
+    if not os.path.isdir(new):
+        return [(old, new)]
+    names = set()
+    for top in (old, new):
+        for (dirpath, _, filenames) in os.walk(top):
+            for name in filenames:
+                if name.endswith('.fd'):
+                    path = os.path.join(dirpath, name)
+                    names.add(os.path.relpath(path, top))
+    result = []
+    for name in sorted(names):
+        (old_path, new_path) = (os.path.join(old, name),
+                                os.path.join(new, name))
+        if not os.path.exists(old_path):
+            sys.stderr.write(f"{name}: added\n")
+        elif not os.path.exists(new_path):
+            sys.stderr.write(f"{name}: removed\n")
+        else:
+            result.append((old_path, new_path))
+    return result
+
+
+def check_budget(report, min_free, max_growth):
+    violations = []
+    for v in report['volumes']:
+        if min_free is not None and v['free'] * 100 < v['size'] * min_free:
+            violations.append(
+                f"{report['new']}: {v['volume']} has only {v['free']} "
+                f"bytes free ({v['free'] * 100 / v['size']:.1f}%)"
+            )
+        growth = v['used'] - v.get('old_used', v['used'])
+        if max_growth is not None and growth > max_growth:
+            violations.append(
+                f"{report['new']}: {v['volume']} grew by {growth} bytes"
+            )
+    return violations
+
+
+def print_report(report):
+    changed = sum(c['end'] - c['start'] for c in report['changed'])
+    sys.stdout.write(
+        "%s: %d -> %d bytes (%+d), %d bytes changed in %d ranges, "
+        "%d bytes moved\n" % (
+            report['new'], report['old_size'], report['new_size'],
+            report['new_size'] - report['old_size'], changed,
+            len(report['changed']), report['moved'],
+        )
+    )
+    for c in report['changed']:
+        sys.stdout.write(
+            "  changed 0x%08x-0x%08x: %d bytes differ\n" %
+            (c['start'], c['end'], c['differing'])
+        )
+    for v in report['volumes']:
+        growth = ''
+        if 'old_used' in v:
+            growth = ' (%+d)' % (v['used'] - v['old_used'])
+        sys.stdout.write(
+            "  FV %s: %d used%s, %d of %d bytes free (%.1f%%)\n" % (
+                v['volume'], v['used'], growth, v['free'], v['size'],
+                v['free'] * 100 / v['size'],
+            )
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare firmware images of two builds.'
+    )
+    parser.add_argument('old', help='.fd file or build output directory')
+    parser.add_argument('new', help='.fd file or build output directory')
+    parser.add_argument(
+        '-j', '--json', action='store_true', help='print JSON',
+    )
+    parser.add_argument(
+        '--min-free', type=float,
+        help='fail if a volume has less than this percentage free',
+    )
+    parser.add_argument(
+        '--max-growth', type=int,
+        help='fail if a volume grew by more than this many bytes',
+    )
+    args = parser.parse_args()
+
+    reports = [compare(old, new) for (old, new) in pairs(args.old, args.new)]
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        for report in reports:
+            print_report(report)
+
+    ret = 0
+    for report in reports:
+        for violation in check_budget(report, args.min_free, args.max_growth):
+            sys.stderr.write(f"BUDGET EXCEEDED: {violation}\n")
+            ret = 1
+    sys.exit(ret)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Write pre-enrolled variants of a VARS template in one go.
+#
+# Usage: PYTHONPATH=./debian/python python3 debian/enroll-vars.py --help
+
+import argparse
+import sys
+
+from UEFI import VarStore
+
+PROFILES = ['vendor', 'snakeoil']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Enroll Secure Boot keys into copies of a VARS template.'
+    )
+    parser.add_argument('template', help='VARS image to start from')
+    parser.add_argument(
+        '-o', '--output', action='append', required=True,
+        metavar='PROFILE:PATH',
+        help='write the template enrolled according to PROFILE (%s) to '
+             'PATH, may be given more than once' % ', '.join(PROFILES),
+    )
+    parser.add_argument(
+        '--vendor-cert', default='debian/PkKek-1-vendor.pem',
+        help='PK/KEK certificate of the vendor profile '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--dbx', help='signed dbx update to apply in the vendor profile',
+    )
+    parser.add_argument(
+        '--snakeoil-cert', default='debian/PkKek-1-snakeoil.pem',
+        help='certificate of the snakeoil profile (default: %(default)s)',
+    )
+    args = parser.parse_args()
+
+    enrollments = {}
+    variants = []
+    for output in args.output:
+        (profile, sep, path) = output.partition(':')
+        if not sep or profile not in PROFILES:
+            parser.error(f'invalid output {output}')
+        if profile not in enrollments:
+            if profile == 'vendor':
+                enrollments[profile] = VarStore.vendor_enrollment(
+                    args.vendor_cert, args.dbx
+                )
+            else:
+                enrollments[profile] = VarStore.snakeoil_enrollment(
+                    args.snakeoil_cert
+                )
+        variants.append((path, enrollments[profile]))
+
+    VarStore.enroll_variants(args.template, variants)
+    for (path, _) in variants:
+        sys.stdout.write("Wrote %s\n" % (path))
@@ -5,72 +5,459 @@
 # ignore list (because they are safe to redistribute), or to the reject list
 # (so that they'll be removed prior to orig.tar.xz generation).
 
+import argparse
+import concurrent.futures
 import glob
+import hashlib
+import json
 import os
 import re
+import struct
 import sys
 
+OKPatterns = [r'\.gitignore', r'AUTHORS', r'FILE.LST', r'Change[lL]og',
+              r'COPYING', r'configure', r'FAQ', r'(GNU)?[Mm]akefile',
+              r'INDEX', r'LICENSE', r'README', r'TODO']
+OKNameRegex = re.compile('|'.join(f'(?:{p})' for p in OKPatterns))
 
-def nameOK(name):
-    OKPatterns = [r'\.gitignore', r'AUTHORS', r'FILE.LST', r'Change[lL]og',
-                  r'COPYING', r'configure', r'FAQ', r'(GNU)?[Mm]akefile',
-                  r'INDEX', r'LICENSE', r'README', r'TODO']
-    OKRegexs = map(re.compile, OKPatterns)
+OKExtensions = frozenset([
+    '1', '3', 'ASL', 'asi', 'asl', 'aslc', 'Asm', 'asm',
+    'asm16', 'bat', 'bmp', 'c', 'CMM', 'cmm', 'cnf', 'cpp',
+    'css', 'dec', 'decTest', 'dlg', 'dsc', 'docx', 'dsp',
+    'dsw', 'el', 'env', 'fdf', 'g', 'gif', 'H', 'h', 'hpp',
+    'html', 'i', 'idf', 'in', 'inc', 'inf', 'info', 'ini',
+    'lds', 'log', 'lua', 'mak', 'makefile', 'md', 'nasm',
+    'nasmb', 'nsh', 'patch', 'pbxuser', 'pbxproj', 'pdf',
+    'pem', 'pl', 'png', 'pod', 'ps', 'py', 'r', 'rtf', 'S',
+    's', 'sct', 'sh', 'sln', 't', 'template', 'txt', 'uni',
+    'Vfr', 'vcproj', 'vfi', 'vfr', 'xml',
+])
 
-    for r in OKRegexs:
-        if r.match(name):
-            return True
-    return False
+
+def nameOK(name):
+    return OKNameRegex.match(name) is not None
 
 
 def extensionOK(name):
-    OKExtensions = ['1', '3', 'ASL', 'asi', 'asl', 'aslc', 'Asm', 'asm',
-                    'asm16', 'bat', 'bmp', 'c', 'CMM', 'cmm', 'cnf', 'cpp',
-                    'css', 'dec', 'decTest', 'dlg', 'dsc', 'docx', 'dsp',
-                    'dsw', 'el', 'env', 'fdf', 'g', 'gif', 'H', 'h', 'hpp',
-                    'html', 'i', 'idf', 'in', 'inc', 'inf', 'info', 'ini',
-                    'lds', 'log', 'lua', 'mak', 'makefile', 'md', 'nasm',
-                    'nasmb', 'nsh', 'patch', 'pbxuser', 'pbxproj', 'pdf',
-                    'pem', 'pl', 'png', 'pod', 'ps', 'py', 'r', 'rtf', 'S',
-                    's', 'sct', 'sh', 'sln', 't', 'template', 'txt', 'uni',
-                    'Vfr', 'vcproj', 'vfi', 'vfr', 'xml']
-    ext = name.split('.')[-1]
-
-    if ext in OKExtensions:
+    return name.rpartition('.')[2] in OKExtensions
+
+
+# How much of each file the content checks look at
+SniffSize = 8192
+
+# (offset, magic, description) of formats that are binary whatever the
+# file is called
+MagicSignatures = [
+    (0, b'\x7fELF', 'ELF object'),
+    (0, b'!<arch>\n', 'ar archive'),
+    (0, b'\x1f\x8b', 'gzip compressed data'),
+    (0, b'\xfd7zXZ\x00', 'xz compressed data'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd compressed data'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7-zip archive'),
+    (0, b'PK\x03\x04', 'zip archive'),
+    (0, b'\xca\xfe\xba\xbe', 'Java class or Mach-O universal binary'),
+    (0, b'\xcf\xfa\xed\xfe', 'Mach-O binary'),
+    (40, b'_FVH', 'UEFI firmware volume'),
+]
+BZip2Regex = re.compile(b'BZh[1-9]1AY&SY')
+# Allowed extensions for formats that are zip archives on the inside
+ContainerExtensions = frozenset(['docx'])
+TextBytes = bytes(range(0x20, 0x7f)) + b'\t\n\r\f\b\x1b'
+# Machine types of EFI images: IA32, X64, IPF, EBC, ARM, AARCH64,
+# RISCV64 and LOONGARCH64
+EfiMachines = frozenset([
+    0x014c, 0x8664, 0x0200, 0x0ebc, 0x01c2, 0xaa64, 0x5064, 0x6264,
+])
+# EFI_TE_IMAGE_HEADER up to StrippedSize
+TeHeader = struct.Struct('<2sHBBH')
+
+
+def sniff_magic(head):
+    '''
+    Returns a description of the binary format head starts with, if any.
+    '''
+    # MZ and VZ alone are too likely at the start of a text file, so
+    # check the headers behind them too
+    if head[:2] == b'MZ' and len(head) >= 0x40:
+        pe_offset = int.from_bytes(head[0x3c:0x40], 'little')
+        if pe_offset >= 0x40 and head[pe_offset:pe_offset + 4] == b'PE\0\0':
+            return 'PE/COFF image'
+    if len(head) >= TeHeader.size:
+        (signature, machine, sections, _, stripped_size) = \
+            TeHeader.unpack_from(head)
+        if (signature == b'VZ' and machine in EfiMachines and
+                sections > 0 and 0x40 <= stripped_size < 0x1000):
+            return 'TE image'
+    if BZip2Regex.match(head):
+        return 'bzip2 compressed data'
+    for (offset, magic, description) in MagicSignatures:
+        if head[offset:offset + len(magic)] == magic:
+            return description
+    return None
+
+
+def binary_content(head):
+    '''
+    Text/binary heuristic. Returns why head looks binary, or None if it
+    looks like text.
+    '''
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        # UTF-16 with BOM, like edk2's .uni files
+        return None
+    if b'\0' in head:
+        return 'contains NUL bytes'
+    try:
+        head.decode('UTF-8')
+        return None
+    except UnicodeDecodeError as err:
+        # The read may have cut a multi-byte sequence in half
+        if (err.start >= len(head) - 3 and
+                err.reason == 'unexpected end of data'):
+            return None
+    nontext = len(head.translate(None, TextBytes))
+    if nontext * 10 > len(head) * 3:
+        return f'{nontext * 100 // len(head)}% non-text bytes'
+    return None
+
+
+def glob_to_regex(pattern):
+    '''
+    Translate a recursive glob pattern, as understood by glob.glob() with
+    recursive=True and include_hidden=True, into a regex matching relative
+    file paths.
+    '''
+    parts = []
+    components = pattern.split('/')
+    for (idx, component) in enumerate(components):
+        last = idx == len(components) - 1
+        if component == '**':
+            parts.append('.+' if last else '(?:[^/]+/)*')
+            continue
+        regex = ''
+        i = 0
+        while i < len(component):
+            c = component[i]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[':
+                # A ']' right after '[' or '[!' is part of the set
+                start = i + 2 if component[i + 1:i + 2] == '!' else i + 1
+                end = component.find(']', start + 1)
+                if end == -1:
+                    regex += re.escape(c)
+                else:
+                    chars = component[i + 1:end].replace('\\', '\\\\')
+                    if chars.startswith('!'):
+                        chars = '^' + chars[1:]
+                    elif chars.startswith('^'):
+                        chars = '\\' + chars
+                    regex += f'[{chars}]'
+                    i = end
+            else:
+                regex += re.escape(c)
+            i += 1
+        parts.append(regex if last else regex + '/')
+    return re.compile(''.join(parts) + r'\Z')
+
+
+class IgnoreIndex:
+    '''
+    Index of the ignore list patterns. Literal paths are kept in a set,
+    patterns of the form <literal dir>/** prune whole directories from the
+    walk, and all other globs are combined into a single regex.
+    '''
+    def __init__(self, patterns):
+        self.paths = set()
+        self.dirs = {}
+        self.globs = {}
+        for pattern in patterns:
+            if not pattern:
+                continue
+            if not glob.has_magic(pattern):
+                self.paths.add(pattern)
+            elif (pattern.endswith('/**') and
+                  not glob.has_magic(pattern[:-len('/**')])):
+                self.dirs[pattern[:-len('/**')]] = pattern
+            else:
+                self.globs[pattern] = glob_to_regex(pattern)
+        self.combined = None
+        if self.globs:
+            self.combined = re.compile('|'.join(
+                f'(?:{r.pattern})' for r in self.globs.values()
+            ))
+        self.unmatched = set(self.paths) | set(self.dirs.values())
+        self.unmatched_globs = set(self.globs)
+
+    def _glob_matches(self, relpath):
+        if self.combined is None or not self.combined.match(relpath):
+            return False
+        for pattern in list(self.unmatched_globs):
+            if self.globs[pattern].match(relpath):
+                self.unmatched_globs.discard(pattern)
         return True
-    return False
+
+    def prunes(self, reldir):
+        # glob.glob() also matches directories, don't warn about patterns
+        # matching one, whether literal or not
+        self.unmatched.discard(reldir)
+        self._glob_matches(reldir)
+        pattern = self.dirs.get(reldir)
+        if pattern is not None:
+            self.unmatched.discard(pattern)
+            return True
+        return False
+
+    def ignores(self, relpath):
+        if relpath in self.paths:
+            self.unmatched.discard(relpath)
+            return True
+        return self._glob_matches(relpath)
+
+    def unmatched_patterns(self, top):
+        # Literal paths below pruned directories are never visited
+        unmatched = [
+            p for p in self.unmatched
+            if p not in self.paths or not os.path.lexists(os.path.join(top, p))
+        ]
+        return sorted(unmatched + list(self.unmatched_globs))
+
+
+def scan_dir(top, reldir, want_stat):
+    files = []
+    dirs = []
+    with os.scandir(os.path.join(top, reldir)) as it:
+        for entry in it:
+            relpath = os.path.join(reldir, entry.name)
+            if entry.is_dir():
+                # Like os.walk(), don't descend into symlinked directories
+                if not entry.is_symlink():
+                    dirs.append(relpath)
+            elif want_stat and not entry.is_symlink():
+                # Symlinks may dangle, and their targets may change
+                # without the link changing: they are always examined
+                st = entry.stat()
+                files.append((relpath, (
+                    st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns,
+                )))
+            else:
+                files.append((relpath, None))
+    return (files, dirs)
+
+
+def walk(top, index, jobs, want_stat=False):
+    '''
+    Yields (relative path, stat stamp or None) for all files below top
+    that are not pruned by index, scanning directories in parallel.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(scan_dir, top, '', want_stat)}
+        while pending:
+            (done, pending) = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                (files, dirs) = future.result()
+                yield from files
+                for reldir in dirs:
+                    if index.prunes(reldir):
+                        print(f"Ignoring: {reldir}/", file=sys.stderr)
+                        continue
+                    pending.add(
+                        pool.submit(scan_dir, top, reldir, want_stat)
+                    )
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    '''
+    (size, mtime, inode, ctime, verdict, reason) of every examined file as
+    of the last clean scan. A file whose stat stamp is unchanged keeps its
+    verdict, any other file is examined again; its content is not hashed,
+    since examining it is hardly more expensive than that. The manifest
+    is only valid for the ignore and remove lists it was created with; if
+    either changed, everything is examined again.
+    '''
+    Version = 3
+
+    def __init__(self, path, list_paths):
+        self.path = path
+        h = hashlib.sha256()
+        for list_path in list_paths:
+            if os.path.exists(list_path):
+                h.update(file_digest(list_path).encode())
+            h.update(b'\0')
+        self.lists_digest = h.hexdigest()
+        self.previous = {}
+        self.current = {}
+        self.reused = 0
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        if (data.get('version') == self.Version and
+                data.get('lists') == self.lists_digest):
+            self.previous = data['files']
+
+    def lookup(self, relpath, stamp):
+        '''
+        Returns the (verdict, reason) recorded for relpath if its stat
+        stamp, (size, mtime, inode, ctime), did not change since, None
+        otherwise.
+        '''
+        entry = self.previous.get(relpath)
+        self.current[relpath] = list(stamp) + [None, None]
+        if entry is not None and entry[:4] == list(stamp):
+            self.current[relpath][4:] = entry[4:]
+            self.reused += 1
+            return tuple(entry[4:])
+        return None
+
+    def record(self, relpath, verdict):
+        self.current[relpath][4:] = verdict
+
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(
+                {
+                    'version': self.Version,
+                    'lists': self.lists_digest,
+                    'files': self.current,
+                },
+                f,
+            )
+        os.replace(tmp, self.path)
+
+
+def examine(top, relpath):
+    '''
+    Returns a ('ok' or 'binary', reason) verdict for a file. Well known
+    binary formats are flagged whatever the file is called, everything
+    else is fine if it has an allowed name or extension or looks like
+    text.
+    '''
+    name = os.path.basename(relpath)
+    ext = name.rpartition('.')[2]
+    try:
+        with open(os.path.join(top, relpath), 'rb') as f:
+            head = f.read(SniffSize)
+    except OSError as err:
+        head = None
+        unreadable = f'unreadable: {err.strerror}'
+
+    if head is not None and ext not in ContainerExtensions:
+        description = sniff_magic(head)
+        if description:
+            return ('binary', description)
+    if nameOK(name):
+        return ('ok', 'allowed name')
+    if extensionOK(name):
+        return ('ok', f'allowed extension .{ext}')
+    if head is None:
+        return ('binary', unreadable)
+    reason = binary_content(head)
+    if reason:
+        return ('binary', reason)
+    return ('ok', 'text content')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Look for files that may be binaries.'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help='number of directories to scan in parallel',
+    )
+    parser.add_argument(
+        '-v', '--explain', action='store_true',
+        help='print the verdict and the reason for it for every file',
+    )
+    parser.add_argument(
+        '-m', '--manifest',
+        help='only examine files that were added or changed since the '
+             'last clean scan recorded in this file, and update it',
+    )
+    args = parser.parse_args()
+
     ret = 0
     top = './'
+    ignore_list = './debian/binary-check.ignore'
+    remove_list = './debian/binary-check.remove'
+
+    with open(ignore_list, 'r') as f:
+        index = IgnoreIndex(list(map(lambda s: s.strip(), f.readlines())))
+    removelist = []
+    if os.path.exists(remove_list):
+        with open(remove_list, 'r') as f:
+            removelist = [s.strip() for s in f.readlines() if s.strip()]
+
+    manifest = None
+    if args.manifest:
+        manifest = Manifest(args.manifest, [ignore_list, remove_list])
 
-    ignorelist = []
-    with open('./debian/binary-check.ignore', 'r') as f:
-        ignoreglobs = list(map(lambda s: s.strip(), f.readlines()))
-    for pattern in ignoreglobs:
-        matches = glob.glob(pattern, recursive=True, include_hidden=True)
-        if len(matches) == 0:
+    ignored = []
+    verdicts = {}
+    unexamined = []
+    for (relpath, stamp) in walk(top, index, args.jobs, bool(manifest)):
+        if index.ignores(relpath):
+            ignored.append(relpath)
+            continue
+        verdict = None
+        if manifest and stamp is not None:
+            verdict = manifest.lookup(relpath, stamp)
+        if verdict is None:
+            unexamined.append(relpath)
+        else:
+            verdicts[relpath] = verdict
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for (relpath, verdict) in zip(
+                unexamined,
+                pool.map(lambda p: examine(top, p), unexamined),
+        ):
+            verdicts[relpath] = verdict
+            if manifest and relpath in manifest.current:
+                manifest.record(relpath, verdict)
+    total = len(verdicts)
+    flagged = [p for (p, (v, _)) in verdicts.items() if v == 'binary']
+
+    for pattern in index.unmatched_patterns(top):
+        print(
+            f"WARNING: pattern {pattern} matched no files.",
+            file=sys.stderr,
+        )
+    for path in removelist:
+        if not os.path.lexists(os.path.join(top, path)):
             print(
-                f"WARNING: pattern {pattern} matched no files.",
+                f"WARNING: remove entry {path} matched no files.",
                 file=sys.stderr,
             )
-        ignorelist += matches
-
-    for root, dirs, files in os.walk(top):
-        for name in files:
-            relpath = os.path.join(root, name)[len(top):]
-            if relpath in ignorelist:
-                print(f"Ignoring: {relpath}", file=sys.stderr)
-                continue
-            if nameOK(name):
-                continue
-            if extensionOK(name):
-                continue
-            else:
-                sys.stdout.write(
-                    "WARNING: Possible binary %s\n" %
-                    (os.path.join(root, name))
-                )
-                ret = -1
+    for relpath in sorted(ignored):
+        print(f"Ignoring: {relpath}", file=sys.stderr)
+    if args.explain:
+        for (relpath, (verdict, reason)) in sorted(verdicts.items()):
+            print(f"{verdict}: {relpath} ({reason})", file=sys.stderr)
+    for relpath in sorted(flagged):
+        sys.stdout.write(
+            "WARNING: Possible binary %s\n" % (os.path.join(top, relpath))
+        )
+        ret = -1
+    if manifest:
+        print(
+            f"Examined {total - manifest.reused} of {total} files, "
+            f"{manifest.reused} unchanged since the last clean scan.",
+            file=sys.stderr,
+        )
+        if ret == 0:
+            manifest.save()
     sys.exit(ret)
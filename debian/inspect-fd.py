@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# List the firmware volumes in flash images, the FFS files in them and how
+# much space is left, following compressed and nested volumes.
+#
+# Usage: PYTHONPATH=./debian/python python3 debian/inspect-fd.py --help
+
+import argparse
+import json
+import sys
+
+from UEFI.FirmwareVolume import FileTypes, FirmwareImage
+
+
+def print_volume(volume, indent, summary):
+    name = volume.name or volume.filesystem
+    sys.stdout.write(
+        "%sFV %s at 0x%x: %d bytes, %d used, %d free, %d padding\n" % (
+            ' ' * indent, name, volume.offset, volume.size, volume.used(),
+            volume.free, volume.padding(),
+        )
+    )
+    for f in volume.files:
+        if not summary and f.type != 0xf0:
+            sys.stdout.write(
+                "%s0x%08x %9d %-22s %s %s\n" % (
+                    ' ' * (indent + 2), f.offset, f.size,
+                    FileTypes.get(f.type, f'0x{f.type:02x}'), f.name,
+                    f.ui_name() or '',
+                )
+            )
+        for nested in f.volumes():
+            print_volume(nested, indent + 4, summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show the content of UEFI firmware images.'
+    )
+    parser.add_argument('images', nargs='+', help='.fd files to inspect')
+    parser.add_argument(
+        '-j', '--json', action='store_true', help='print JSON',
+    )
+    parser.add_argument(
+        '-s', '--summary', action='store_true',
+        help='only show the volumes, not the files in them',
+    )
+    args = parser.parse_args()
+
+    results = []
+    for path in args.images:
+        with FirmwareImage(path) as image:
+            if args.json:
+                results.append(image.to_dict())
+                continue
+            sys.stdout.write("%s: %d bytes\n" % (path, image.size))
+            for volume in image.volumes:
+                print_volume(volume, 2, args.summary)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Stream a source tree into an orig tarball, leaving out the files listed
+# in binary-check.remove and anything matching an exclude pattern, without
+# staging a filtered copy of the tree first. Entries are added in sorted
+# order with normalized owners, permissions and clamped mtimes, so the
+# same tree always gives the same tarball.
+
+import argparse
+import contextlib
+import fnmatch
+import gzip
+import lzma
+import os
+import stat
+import sys
+import tarfile
+
+
+@contextlib.contextmanager
+def open_output(path, name):
+    '''
+    Opens path for writing, compressed according to the extension of
+    name. The compressors are set up not to record anything but the data
+    itself.
+    '''
+    if not name.endswith(('.tar', '.tar.gz', '.tgz', '.tar.xz')):
+        raise ValueError(f"unsupported tarball extension: {name}")
+    with open(path, 'wb') as f:
+        if name.endswith(('.tar.gz', '.tgz')):
+            with gzip.GzipFile(
+                    filename='', mode='wb', fileobj=f, mtime=0
+            ) as gz:
+                yield gz
+        elif name.endswith('.tar.xz'):
+            with lzma.LZMAFile(f, 'wb', preset=6) as xz:
+                yield xz
+        else:
+            yield f
+
+
+class TreeFilter:
+    '''
+    Decides which paths, relative to the top of the source tree, go into
+    the tarball. Excluded directories are not descended into.
+    '''
+    def __init__(self, removelist, excludes):
+        self.removelist = set(removelist)
+        self.excludes = excludes
+        self.removed = set()
+
+    def excluded(self, relpath):
+        if relpath in self.removelist:
+            self.removed.add(relpath)
+            return True
+        return any(fnmatch.fnmatchcase(relpath, p) for p in self.excludes)
+
+    def missing(self):
+        return sorted(self.removelist - self.removed)
+
+
+def walk(top, tree_filter, reldir=''):
+    '''
+    Yields (relative path, stat result) for everything below top that
+    passes tree_filter, depth first in byte order of the names.
+    '''
+    with os.scandir(os.path.join(top, reldir) if reldir else top) as it:
+        entries = sorted(it, key=lambda e: os.fsencode(e.name))
+    for entry in entries:
+        relpath = os.path.join(reldir, entry.name)
+        if tree_filter.excluded(relpath):
+            continue
+        st = entry.stat(follow_symlinks=False)
+        yield (relpath, st)
+        if stat.S_ISDIR(st.st_mode):
+            yield from walk(top, tree_filter, relpath)
+
+
+def tarinfo(top, prefix, relpath, st, mtime):
+    info = tarfile.TarInfo(os.path.join(prefix, relpath))
+    info.mtime = min(int(st.st_mtime), mtime)
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(os.path.join(top, relpath))
+        info.mode = 0o777
+    elif stat.S_ISREG(st.st_mode):
+        # Hard links are stored as separate copies
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+        info.mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+    else:
+        return None
+    return info
+
+
+def write_tarball(top, output, prefix, tree_filter, mtime):
+    tmp = f'{output}.tmp'
+    try:
+        with open_output(tmp, output) as f, \
+             tarfile.open(fileobj=f, mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            tar.addfile(tarinfo(top, prefix, '', os.stat(top), mtime))
+            for (relpath, st) in walk(top, tree_filter):
+                info = tarinfo(top, prefix, relpath, st, mtime)
+                if info is None:
+                    sys.stderr.write(f"Skipping special file {relpath}\n")
+                    continue
+                if info.isreg():
+                    with open(os.path.join(top, relpath), 'rb') as src:
+                        tar.addfile(info, src)
+                else:
+                    tar.addfile(info)
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create a filtered, reproducible orig tarball.'
+    )
+    parser.add_argument('srcdir', help='top of the source tree')
+    parser.add_argument(
+        'output', help='tarball to write (.tar, .tar.gz/.tgz or .tar.xz)',
+    )
+    parser.add_argument(
+        '-p', '--prefix',
+        help='directory to put everything under in the tarball '
+             '(default: the name of srcdir)',
+    )
+    parser.add_argument(
+        '-r', '--remove-list',
+        help='file listing paths, relative to srcdir, to leave out',
+    )
+    parser.add_argument(
+        '-x', '--exclude', action='append', default=[],
+        help='leave out paths relative to srcdir matching this glob '
+             'pattern, may be given more than once',
+    )
+    parser.add_argument(
+        '--mtime', type=int, default=os.environ.get('SOURCE_DATE_EPOCH'),
+        help='clamp all mtimes to this timestamp '
+             '(default: SOURCE_DATE_EPOCH)',
+    )
+    args = parser.parse_args()
+
+    if args.mtime is None:
+        parser.error('--mtime or SOURCE_DATE_EPOCH is required')
+    prefix = args.prefix
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(args.srcdir))
+
+    removelist = []
+    if args.remove_list:
+        with open(args.remove_list, 'r') as f:
+            removelist = [s.strip() for s in f.readlines() if s.strip()]
+    tree_filter = TreeFilter(removelist, args.exclude)
+
+    write_tarball(args.srcdir, args.output, prefix, tree_filter, args.mtime)
+    for path in sorted(tree_filter.removed):
+        sys.stdout.write("Removing %s\n" % (path))
+
+    missing = tree_filter.missing()
+    for path in missing:
+        sys.stderr.write(f"ERROR: remove entry {path} not found\n")
+    if missing:
+        os.unlink(args.output)
+        sys.exit(1)
@@ -0,0 +1,201 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import subprocess
+import tempfile
+
+_file_digests = {}
+_tool_versions = {}
+_default_cache = None
+
+
+def file_digest(path):
+    '''
+    sha256 of a file's content, memoized for as long as the file's size,
+    mtime and inode stay the same.
+    '''
+    st = os.stat(path)
+    stamp = (os.path.realpath(path), st.st_ino, st.st_size, st.st_mtime_ns)
+    if stamp not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        _file_digests[stamp] = h.hexdigest()
+    return _file_digests[stamp]
+
+
+def tool_version(argv):
+    '''
+    First line of a tool's version output, memoized per process.
+    '''
+    argv = tuple(argv)
+    if argv not in _tool_versions:
+        out = subprocess.run(
+            argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            encoding='UTF-8', errors='replace',
+        ).stdout
+        _tool_versions[argv] = out.splitlines()[0] if out else ''
+    return _tool_versions[argv]
+
+
+def copy_sparse(src, dst):
+    '''
+    Copy a file, only transferring the data regions of src so holes stay
+    holes in dst.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        fdst.truncate(size)
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fsrc.fileno(), offset, os.SEEK_DATA)
+            except OSError:
+                break
+            end = os.lseek(fsrc.fileno(), start, os.SEEK_HOLE)
+            os.lseek(fsrc.fileno(), start, os.SEEK_SET)
+            fdst.seek(start)
+            remaining = end - start
+            while remaining:
+                chunk = fsrc.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                remaining -= len(chunk)
+            offset = end
+
+
+class ArtifactCache:
+    '''
+    Persistent store of generated artifacts, addressed by a key derived
+    from everything that went into building them. Entries are evicted in
+    least-recently-used order once the cache grows beyond max_size bytes.
+    A lock file serializes eviction against concurrent readers and
+    writers, which may be separate processes.
+    '''
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+        self.lock_path = os.path.join(self.path, '.lock')
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(repr(part).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @contextlib.contextmanager
+    def _locked(self, mode):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, dest):
+        '''
+        Copy the entry for key to dest. Returns False on a cache miss.
+        '''
+        entry = self._entry(key)
+        with self._locked(fcntl.LOCK_SH):
+            if not os.path.exists(entry):
+                return False
+            copy_sparse(entry, dest)
+            os.utime(entry)
+        return True
+
+    def put(self, key, src):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        os.close(fd)
+        try:
+            copy_sparse(src, tmp)
+            with self._locked(fcntl.LOCK_EX):
+                os.replace(tmp, self._entry(key))
+                self._evict()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_blocks * 512, entry.path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.unlink(path)
+            total -= size
+
+
+def default_cache():
+    '''
+    The cache used for generated boot media, saved VM states and learned
+    boot deadlines, set up through UEFI_MEDIA_CACHE and
+    UEFI_MEDIA_CACHE_SIZE (in MiB, default 1024). UEFI_MEDIA_CACHE is a
+    directory, "on" for one below XDG_CACHE_HOME or "off". Unset, the
+    cache lives in AUTOPKGTEST_TMP under autopkgtest, so that the tests
+    of one run share it and nothing outlives the testbed, and is off
+    otherwise: local runs opt in, as warm starts need them to.
+    Returns None if caching is disabled or the directory is unusable.
+    '''
+    global _default_cache
+    if _default_cache is not None:
+        return _default_cache or None
+
+    path = os.environ.get('UEFI_MEDIA_CACHE')
+    if path is None:
+        path = 'off'
+        if 'AUTOPKGTEST_TMP' in os.environ:
+            path = os.path.join(
+                os.environ['AUTOPKGTEST_TMP'], 'pve-edk2-firmware-media'
+            )
+    elif path == 'on':
+        cache_home = os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')
+        )
+        path = os.path.join(cache_home, 'pve-edk2-firmware', 'media')
+
+    _default_cache = False
+    if path == 'off':
+        return None
+    size = os.environ.get('UEFI_MEDIA_CACHE_SIZE', '1024')
+    if not size.isdigit() or int(size) == 0:
+        raise ValueError(
+            "UEFI_MEDIA_CACHE_SIZE must be a positive number of MiB, not "
+            f"{size!r}"
+        )
+    try:
+        _default_cache = ArtifactCache(path, int(size) << 20)
+    except OSError:
+        pass
+    return _default_cache or None
@@ -0,0 +1,521 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import codecs
+import re
+
+from UEFI.Qmp import AsyncQmpClient
+from UEFI.Timeline import BootMilestone
+
+BDS_PROMPT = 'Press .* or any other key to continue'
+SHELL_PROMPT = 'Shell> '
+FS0_PROMPT = 'FS0:\\\\> '
+
+
+class FailureReason:
+    ASSERT = 'assert'
+    BOOT_FAILED = 'boot_failed'
+    CPU_EXCEPTION = 'cpu_exception'
+    GUEST_PANICKED = 'guest_panicked'
+    GUEST_STOPPED = 'guest_stopped'
+    INACTIVITY = 'inactivity'
+    PHASE_DEADLINE = 'phase_deadline'
+    TIMEOUT = 'timeout'
+
+
+class ConsoleError(Exception):
+    '''
+    reason classifies the failure, see FailureReason.
+    '''
+    def __init__(self, message, reason=None):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ConsoleTimeout(ConsoleError):
+    def __init__(self, message, reason=FailureReason.TIMEOUT):
+        super().__init__(message, reason)
+
+
+class Fatal:
+    '''
+    Console output that means the boot has failed, no matter the state of
+    the flow, like a firmware assertion. The pattern only matches once
+    its line is complete, so that the whole line gets reported.
+    '''
+    def __init__(self, reason, pattern):
+        self.reason = reason
+        self.pattern = re.compile(pattern + r'(?=\r?\n)')
+
+
+# Fatal output of EDK2
+FATAL_PATTERNS = [
+    Fatal(FailureReason.ASSERT, r'ASSERT(?:_EFI_ERROR)? [^\r\n]*'),
+    Fatal(FailureReason.CPU_EXCEPTION,
+          r'!!!! (?:X64|IA32) Exception Type - [^\r\n]*'),
+    Fatal(FailureReason.CPU_EXCEPTION,
+          r'(?:Synchronous|SError) Exception at 0x[0-9A-Fa-f]+[^\r\n]*'),
+    Fatal(FailureReason.BOOT_FAILED, r'\bBoot Failed\b[^\r\n]*'),
+    Fatal(FailureReason.BOOT_FAILED,
+          r'No bootable option or device was found\.[^\r\n]*'),
+]
+
+
+class Transition:
+    '''
+    One edge of a console state machine: when pattern shows up on the
+    console, record the milestones in mark, merge values into the result,
+    send a line and move on to next_state (or stay in the current one).
+    '''
+    def __init__(
+            self, pattern, send=None, next_state=None, mark=(), values=None,
+    ):
+        self.pattern = re.compile(pattern)
+        self.send = send
+        self.next_state = next_state
+        self.mark = [mark] if isinstance(mark, str) else list(mark)
+        self.values = values or {}
+
+
+class ConsoleFlow:
+    '''
+    A declarative console interaction, mapping each state name to the
+    transitions that are active in it. Output matching any of fatal ends
+    the interaction with a ConsoleError in every state.
+    '''
+    def __init__(self, states, initial, fatal=FATAL_PATTERNS):
+        self.states = states
+        self.initial = initial
+        self.fatal = fatal
+
+    def match(self, state, output):
+        '''
+        Returns the transition whose pattern matches earliest in output
+        and the match, like pexpect does for a list of patterns.
+        '''
+        best = None
+        for transition in self.states[state]:
+            m = transition.pattern.search(output)
+            if m and (best is None or m.start() < best[1].start()):
+                best = (transition, m)
+        return best
+
+    def match_fatal(self, output):
+        '''
+        Returns the fatal pattern that matches earliest in output and the
+        match, if any does.
+        '''
+        best = None
+        for fatal in self.fatal:
+            m = fatal.pattern.search(output)
+            if m and (best is None or m.start() < best[1].start()):
+                best = (fatal, m)
+        return best
+
+
+class Watchdog:
+    '''
+    Gives up on a console run before the timeout of its step: when there
+    was no output for inactivity seconds, or the run did not get past a
+    milestone of its timeline in time. phase_deadlines maps milestones to
+    the seconds the phase after them may take, see PhaseHistory.
+    '''
+    def __init__(self, inactivity=None, phase_deadlines=None):
+        self.inactivity = inactivity
+        self.phase_deadlines = phase_deadlines or {}
+
+    def deadline(self, last_output, timeline=None):
+        '''
+        The earliest (time, reason, description) at which to give up, as
+        in time.monotonic(), or None. last_output is when the console
+        printed something last.
+        '''
+        deadlines = []
+        if self.inactivity:
+            deadlines.append((
+                last_output + self.inactivity, FailureReason.INACTIVITY,
+                f"no output for {self.inactivity}s",
+            ))
+        if timeline is not None and timeline.milestones:
+            (milestone, t) = timeline.milestones[-1]
+            if milestone in self.phase_deadlines:
+                allowed = self.phase_deadlines[milestone]
+                deadlines.append((
+                    timeline.start + t + allowed,
+                    FailureReason.PHASE_DEADLINE,
+                    f"no progress within {allowed:.1f}s after {milestone}",
+                ))
+        return min(deadlines, default=None)
+
+
+class ConsoleResult:
+    '''
+    events are the QMP events received during the run and stats what
+    AsyncQmpClient.stats() reported when the guest powered off, if the
+    console had a QMP connection.
+    '''
+    def __init__(self, exitstatus, state, values, events=(), stats=None):
+        self.exitstatus = exitstatus
+        self.state = state
+        self.values = values
+        self.events = list(events)
+        self.stats = stats
+
+
+class _AttachedProcess:
+    '''
+    Gives a subprocess.Popen that is already running the interface of an
+    asyncio subprocess, as far as Console uses it.
+    '''
+    def __init__(self, popen, stdin, stdout, transports):
+        self.popen = popen
+        self.stdin = stdin
+        self.stdout = stdout
+        self.transports = transports
+
+    @classmethod
+    async def attach(cls, popen):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        (read_transport, _) = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), popen.stdout
+        )
+        (write_transport, protocol) = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+            popen.stdin,
+        )
+        writer = asyncio.StreamWriter(write_transport, protocol, None, loop)
+        return cls(popen, writer, reader, [read_transport, write_transport])
+
+    @property
+    def returncode(self):
+        return self.popen.poll()
+
+    def kill(self):
+        self.popen.kill()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.popen.wait)
+
+    def detach(self):
+        for transport in self.transports:
+            transport.close()
+
+
+class Console:
+    '''
+    Drives the serial console of one VM, given as an argv list, through a
+    ConsoleFlow until the VM exits. timeout applies to each step, like the
+    timeout of a pexpect expect call. Any number of consoles can be run
+    concurrently from one event loop, see run_consoles().
+    Instead of being started, the VM can be an already running
+    subprocess.Popen with stdin and stdout pipes, passed as process, like
+    one from a QemuPool; argv is then only informational.
+
+    With qmp_path, the QMP socket of a QemuCommand.enable_qmp(), the run
+    ends as soon as the guest powers off rather than when the console is
+    closed, and fails right away when QEMU stops the guest for good
+    instead of running into the timeout.
+
+    Output matching a fatal pattern of the flow fails the run right away,
+    and so does a watchdog, if given, running out.
+    ConsoleError.reason tells why a run failed. The reason is also stored
+    in the timeline.
+    '''
+    MaxOutput = 64 * 1024
+    # Output before the latest data that is searched for fatal patterns,
+    # for lines that arrive in pieces
+    FatalContext = 256
+    # Run states QEMU does not leave without outside help
+    FatalStatus = ['guest-panicked', 'internal-error', 'io-error']
+
+    def __init__(
+            self, argv, flow, timeout, logfile=None, timeline=None,
+            initial_input=None, process=None, qmp_path=None, watchdog=None,
+    ):
+        self.argv = argv
+        self.flow = flow
+        self.timeout = timeout
+        self.logfile = logfile
+        self.timeline = timeline
+        self.initial_input = initial_input
+        self.process = process
+        self.qmp_path = qmp_path
+        self.watchdog = watchdog
+
+    def _mark(self, milestone):
+        if self.timeline is not None:
+            self.timeline.mark(milestone)
+
+    async def _sendline(self, proc, line):
+        proc.stdin.write((line + '\n').encode())
+        await proc.stdin.drain()
+
+    async def _watch_guest(self, qmp):
+        '''
+        Returns the event that ends the guest's life: it powered off or
+        QEMU stopped it for good. None if QEMU closed the connection.
+        '''
+        while True:
+            event = await qmp.next_event()
+            if event is None:
+                return None
+            if event['event'] in ['SHUTDOWN', 'GUEST_PANICKED']:
+                return event
+            if event['event'] == 'STOP':
+                try:
+                    status = await qmp.query_status()
+                except (EOFError, ConnectionError):
+                    return None
+                if status in self.FatalStatus:
+                    return dict(event, status=status)
+
+    async def _vm_status(self, qmp):
+        if qmp is None:
+            return ''
+        try:
+            status = await asyncio.wait_for(qmp.query_status(), 5)
+        except (asyncio.TimeoutError, EOFError, ConnectionError):
+            status = 'not responding'
+        return f", VM status: {status}"
+
+    async def run(self):
+        try:
+            return await self._run()
+        except ConsoleError as err:
+            if self.timeline is not None:
+                self.timeline.info['failure'] = {
+                    'reason': err.reason, 'message': str(err),
+                }
+            raise
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self._mark(BootMilestone.SPAWN)
+        if self.process is not None:
+            proc = await _AttachedProcess.attach(self.process)
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                *self.argv,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+        decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+        state = self.flow.initial
+        values = {}
+        output = ''
+        qmp = None
+        stats = None
+        # Pending read of the console and watch of the guest's state
+        reader = None
+        watcher = None
+        try:
+            if self.qmp_path is not None:
+                qmp = await AsyncQmpClient.connect(self.qmp_path)
+                watcher = asyncio.ensure_future(self._watch_guest(qmp))
+            if self.initial_input is not None:
+                await self._sendline(proc, self.initial_input)
+            deadline = loop.time() + self.timeout
+            last_output = loop.time()
+            while True:
+                match = self.flow.match(state, output)
+                if match:
+                    (transition, m) = match
+                    output = output[m.end():]
+                    for milestone in transition.mark:
+                        self._mark(milestone)
+                    values.update(transition.values)
+                    if transition.send is not None:
+                        await self._sendline(proc, transition.send)
+                    if transition.next_state is not None:
+                        state = transition.next_state
+                    deadline = loop.time() + self.timeout
+                    continue
+                if reader is None:
+                    reader = asyncio.ensure_future(proc.stdout.read(4096))
+                watchdog = None
+                if self.watchdog is not None:
+                    watchdog = self.watchdog.deadline(
+                        last_output, self.timeline
+                    )
+                    if watchdog is not None and watchdog[0] >= deadline:
+                        watchdog = None
+                (done, _) = await asyncio.wait(
+                    [t for t in (reader, watcher) if t is not None],
+                    timeout=max(
+                        0, (watchdog or (deadline,))[0] - loop.time()
+                    ),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if watcher in done:
+                    event = watcher.result()
+                    watcher = None
+                    if event is None:
+                        continue
+                    if event['event'] != 'SHUTDOWN':
+                        raise ConsoleError(
+                            "Guest stopped (%s) in state %s, last output: "
+                            "%r" % (
+                                event.get('status', event['event']), state,
+                                output[-256:],
+                            ),
+                            FailureReason.GUEST_PANICKED
+                            if event['event'] == 'GUEST_PANICKED' or
+                            event.get('status') == 'guest-panicked'
+                            else FailureReason.GUEST_STOPPED,
+                        )
+                    # QEMU waits in the shutdown state to be told to quit,
+                    # the console is closed once it did
+                    self._mark(BootMilestone.POWER_OFF)
+                    try:
+                        stats = await qmp.stats()
+                    except (EOFError, ConnectionError):
+                        pass
+                    await qmp.quit()
+                    continue
+                if reader not in done:
+                    if watchdog is not None:
+                        (_, reason, description) = watchdog
+                        raise ConsoleTimeout(
+                            "Watchdog expired in state %s, %s%s, last "
+                            "output: %r" % (
+                                state, description,
+                                await self._vm_status(qmp), output[-256:],
+                            ),
+                            reason,
+                        )
+                    raise ConsoleTimeout(
+                        "Timeout exceeded in state %s%s, last output: %r" %
+                        (state, await self._vm_status(qmp), output[-256:])
+                    )
+                data = reader.result()
+                reader = None
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if self.timeline is not None:
+                    self.timeline.output_received(text)
+                if self.logfile is not None:
+                    self.logfile.write(text)
+                    self.logfile.flush()
+                output = (output + text)[-self.MaxOutput:]
+                last_output = loop.time()
+                fatal = self.flow.match_fatal(
+                    output[-(len(text) + self.FatalContext):]
+                )
+                if fatal:
+                    (fatal, m) = fatal
+                    raise ConsoleError(
+                        "Fatal output in state %s: %r" % (
+                            state, m.group(0).strip()
+                        ),
+                        fatal.reason,
+                    )
+            self._mark(BootMilestone.EXIT)
+            await proc.wait()
+        finally:
+            for task in (reader, watcher):
+                if task is not None:
+                    task.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if qmp is not None:
+                await qmp.close()
+            if self.process is not None:
+                proc.detach()
+        if stats is not None and self.timeline is not None:
+            self.timeline.info['stats'] = stats
+        return ConsoleResult(
+            proc.returncode, state, values,
+            qmp.received if qmp is not None else (), stats,
+        )
+
+
+async def run_consoles(consoles):
+    '''
+    Run several consoles concurrently. Returns their results (or the
+    exception each one raised) in the same order.
+    '''
+    return await asyncio.gather(
+        *[console.run() for console in consoles], return_exceptions=True
+    )
+
+
+def run_console(*args, **kwargs):
+    return asyncio.run(Console(*args, **kwargs).run())
+
+
+def shell_flow():
+    '''
+    Boot to the UEFI shell and shut down from there.
+    '''
+    return ConsoleFlow(
+        {
+            'boot': [
+                Transition(BDS_PROMPT, send='\x1b',
+                           mark=BootMilestone.BDS_PROMPT),
+                Transition(SHELL_PROMPT, send='reset -s\r',
+                           mark=[BootMilestone.SHELL_PROMPT,
+                                 BootMilestone.SHUTDOWN_REQUEST]),
+            ],
+        },
+        initial='boot',
+    )
+
+
+def secure_boot_flow(efiarch):
+    '''
+    Boot to the UEFI shell, start the removable media boot loader from
+    FS0: and shut down again. values['verified'] tells whether the boot
+    loader (a shim chain loading GRUB) passed Secure Boot verification.
+    Failed boots are not fatal, the Boot Manager failing to start the
+    boot loader from the media before the shell comes up is expected
+    when it does not verify.
+    '''
+    common = [
+        Transition(BDS_PROMPT, send='\x1b', mark=BootMilestone.BDS_PROMPT),
+        Transition(SHELL_PROMPT, send='fs0:\r',
+                   mark=BootMilestone.SHELL_PROMPT),
+        Transition('grub> ', send='halt\r', values={'verified': True},
+                   mark=[BootMilestone.GRUB_PROMPT,
+                         BootMilestone.SHUTDOWN_REQUEST]),
+        Transition('Command Error Status: Access Denied',
+                   values={'verified': False},
+                   mark=BootMilestone.ACCESS_DENIED),
+    ]
+    return ConsoleFlow(
+        {
+            'pre_exec': common + [
+                Transition(FS0_PROMPT,
+                           send=f'\\efi\\boot\\boot{efiarch}.efi\r',
+                           next_state='post_exec',
+                           mark=BootMilestone.BOOT_LOADER_START),
+            ],
+            'post_exec': common + [
+                Transition(FS0_PROMPT, send='reset -s\r',
+                           mark=BootMilestone.SHUTDOWN_REQUEST),
+            ],
+        },
+        initial='pre_exec',
+        fatal=[
+            f for f in FATAL_PATTERNS
+            if f.reason != FailureReason.BOOT_FAILED
+        ],
+    )
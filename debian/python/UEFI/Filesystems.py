@@ -16,60 +16,377 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import errno
 import os
 import shutil
+import struct
 import subprocess
-import tempfile
+import time
+
+from UEFI.Cache import (
+    ArtifactCache, copy_sparse, default_cache, file_digest, tool_version
+)
+from UEFI.Scratch import default_scratch
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dostime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return (date, dostime)
+
+
+class _FatNode:
+    ShortNameChars = frozenset(
+        'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&'
+    )
+
+    def __init__(self, name, timestamp, src=None):
+        self.name = name
+        self.timestamp = timestamp
+        self.src = src
+        self.size = 0 if src is None else os.path.getsize(src)
+        self.children = {} if src is None else None
+        self.short_name = None
+        self.lfn = None
+        self.cluster = 0
+
+    @property
+    def is_dir(self):
+        return self.src is None
+
+    def _short_name_ok(self, name):
+        (base, dot, ext) = name.partition('.')
+        if '.' in ext or not 1 <= len(base) <= 8 or len(ext) > 3:
+            return False
+        if dot and not ext:
+            return False
+        return all(c in self.ShortNameChars for c in base + ext)
+
+    def add_child(self, node):
+        key = node.name.upper()
+        if key in self.children:
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  node.name)
+        used = {c.short_name for c in self.children.values()}
+        (base, _, ext) = node.name.partition('.')
+        short_name = f'{base:8}{ext:3}'.encode('ascii', 'replace')
+        if self._short_name_ok(node.name) and short_name not in used:
+            node.short_name = short_name
+        else:
+            (base, _, ext) = node.name.upper().lstrip('.').rpartition('.')
+            if not base:
+                (base, ext) = (ext, '')
+            base = ''.join(c if c in self.ShortNameChars else '_'
+                           for c in base if c not in ' .')
+            ext = ''.join(c if c in self.ShortNameChars else '_'
+                          for c in ext if c != ' ')[:3]
+            for n in range(1, 1000000):
+                tail = f'~{n}'
+                short = f'{base[:8 - len(tail)]}{tail}'
+                short_name = f'{short:8}{ext:3}'.encode('ascii')
+                if short_name not in used:
+                    break
+            node.short_name = short_name
+            node.lfn = node.name
+        self.children[key] = node
+
+    def lfn_entries(self):
+        if self.lfn is None:
+            return []
+        checksum = 0
+        for c in self.short_name:
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xff
+        name = self.lfn.encode('utf-16-le') + b'\x00\x00'
+        chunks = []
+        for offset in range(0, len(self.lfn.encode('utf-16-le')), 26):
+            chunk = name[offset:offset + 26]
+            chunks.append(chunk + b'\xff' * (26 - len(chunk)))
+        entries = []
+        for (seq, chunk) in enumerate(chunks, start=1):
+            if seq == len(chunks):
+                seq |= 0x40
+            entries.append(
+                struct.pack('<B10sBBB12sH4s', seq, chunk[0:10], 0x0f, 0,
+                            checksum, chunk[10:22], 0, chunk[22:26])
+            )
+        return list(reversed(entries))
+
+    def manifest(self):
+        if not self.is_dir:
+            return (self.name, file_digest(self.src))
+        return (self.name, [c.manifest() for c in self.children.values()])
+
+    def entry_count(self):
+        count = 0
+        for child in self.children.values():
+            count += 1 + len(child.lfn_entries())
+        return count
+
+    def dir_entry(self, short_name=None, cluster=None):
+        (date, dostime) = _dos_datetime(self.timestamp)
+        if cluster is None:
+            cluster = self.cluster
+        return struct.pack(
+            '<11sBBBHHHHHHHI',
+            short_name or self.short_name,
+            0x10 if self.is_dir else 0x20,
+            0, 0, dostime, date, date,
+            cluster >> 16, dostime, date, cluster & 0xffff,
+            0 if self.is_dir else self.size,
+        )
 
 
 class FatFsImage:
+    '''
+    A FAT32 filesystem image, built without any external tools. mkdir and
+    insert_file only record the layout; the image is written to a sparse
+    file in a single pass the first time its path is requested, so only
+    the sectors in use are ever written out. The file is in the scratch
+    space and goes away with close(), or at the end of a with block.
+    '''
+    SectorSize = 512
+    ReservedSectors = 32
+    NumFats = 2
+    FsInfoSector = 1
+    BackupBootSector = 6
+    RootCluster = 2
+    MinClusters = 65525
+    EndOfChain = 0x0fffffff
+    # Bump whenever the generated layout changes, to invalidate cached images
+    Version = 1
+
     def __init__(self, size_in_mb):
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            self.path = f.name
-
-        subprocess.check_call(
-            [
-                'dd', 'if=/dev/zero', 'of=%s' % (self.path),
-                'count=0', 'bs=1M', 'seek=%d' % (size_in_mb), 'status=none'
-            ]
-        )
-        new_env = os.environ.copy()
-        new_env['PATH'] = f"{os.environ['PATH']}:/sbin"
-        subprocess.check_call(['mkdosfs', '-F', '32', self.path], env=new_env)
+        self._file = default_scratch().file(suffix='.img')
+        self._path = self._file.path
+
+        self.total_sectors = size_in_mb * 1024 * 1024 // self.SectorSize
+        if size_in_mb <= 260:
+            self.sectors_per_cluster = 1
+        elif size_in_mb <= 8 * 1024:
+            self.sectors_per_cluster = 8
+        elif size_in_mb <= 16 * 1024:
+            self.sectors_per_cluster = 16
+        elif size_in_mb <= 32 * 1024:
+            self.sectors_per_cluster = 32
+        else:
+            self.sectors_per_cluster = 64
+        self.fat_sectors = 1
+        while True:
+            data_sectors = (
+                self.total_sectors - self.ReservedSectors -
+                self.NumFats * self.fat_sectors
+            )
+            self.num_clusters = data_sectors // self.sectors_per_cluster
+            needed = -(-(self.num_clusters + 2) * 4 // self.SectorSize)
+            if needed <= self.fat_sectors:
+                break
+            self.fat_sectors = needed
+        if self.num_clusters < self.MinClusters:
+            raise ValueError(f"{size_in_mb} MB is too small for FAT32")
+
+        self.timestamp = time.time()
+        self.root = _FatNode('', self.timestamp)
+        self.dirty = True
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    def __del__(self):
-        os.unlink(self.path)
+    @property
+    def path(self):
+        if self.dirty:
+            self._write()
+        return self._path
+
+    def _lookup(self, path):
+        node = self.root
+        for name in path.replace('\\', '/').split('/'):
+            if not name:
+                continue
+            if node.is_dir and name.upper() in node.children:
+                node = node.children[name.upper()]
+            else:
+                raise FileNotFoundError(errno.ENOENT,
+                                        os.strerror(errno.ENOENT), path)
+        return node
+
+    def _add(self, path, src=None):
+        (parent, _, name) = path.replace('\\', '/').strip('/').rpartition('/')
+        parent_node = self._lookup(parent)
+        if not parent_node.is_dir:
+            raise NotADirectoryError(errno.ENOTDIR,
+                                     os.strerror(errno.ENOTDIR), parent)
+        timestamp = self.timestamp if src is None else os.stat(src).st_mtime
+        parent_node.add_child(_FatNode(name, timestamp, src))
+        self.dirty = True
 
     def mkdir(self, dir):
-        subprocess.run(['mmd', '-i', self.path, dir])
+        self._add(dir)
 
     def makedirs(self, dir):
         dirs = dir.split(os.path.sep)
         for dir_idx in range(1, len(dirs)+1):
             next_dir = os.path.sep.join(dirs[:dir_idx])
-            self.mkdir(next_dir)
+            try:
+                self._lookup(next_dir)
+            except FileNotFoundError:
+                self.mkdir(next_dir)
 
     def insert_file(self, src, dest):
-        subprocess.check_call(
-            [
-                'mcopy', '-i', self.path, src, '::%s' % (dest)
-            ]
+        self._add(dest, src)
+
+    @property
+    def cache_key(self):
+        return ArtifactCache.key(
+            type(self).__name__, self.Version, self.total_sectors,
+            self.root.manifest(),
+        )
+
+    def _cluster_offset(self, cluster):
+        data_start = self.ReservedSectors + self.NumFats * self.fat_sectors
+        sector = data_start + (cluster - 2) * self.sectors_per_cluster
+        return sector * self.SectorSize
+
+    def _layout(self, node, next_cluster, chains):
+        cluster_size = self.sectors_per_cluster * self.SectorSize
+        if node.is_dir:
+            count = node.entry_count() + (0 if node is self.root else 2)
+            length = max(1, -(-count * 32 // cluster_size))
+        else:
+            length = -(-node.size // cluster_size)
+        if length:
+            node.cluster = next_cluster
+            chains.append((next_cluster, length))
+            next_cluster += length
+        if node.is_dir:
+            for child in node.children.values():
+                next_cluster = self._layout(child, next_cluster, chains)
+        return next_cluster
+
+    def _boot_sector(self, volume_id):
+        bs = bytearray(self.SectorSize)
+        struct.pack_into(
+            '<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s', bs, 0,
+            b'\xeb\x58\x90', b'mkfs.fat', self.SectorSize,
+            self.sectors_per_cluster, self.ReservedSectors, self.NumFats,
+            0, 0, 0xf8, 0, 32, 64, 0, self.total_sectors, self.fat_sectors,
+            0, 0, self.RootCluster, self.FsInfoSector, self.BackupBootSector,
+            b'', 0x80, 0, 0x29, volume_id, b'NO NAME    ', b'FAT32   ',
         )
+        bs[510:512] = b'\x55\xaa'
+        return bytes(bs)
+
+    def _fsinfo_sector(self, free_clusters, next_free):
+        fsinfo = bytearray(self.SectorSize)
+        struct.pack_into('<I', fsinfo, 0, 0x41615252)
+        struct.pack_into('<IIII', fsinfo, 484, 0x61417272,
+                         free_clusters, next_free, 0)
+        struct.pack_into('<I', fsinfo, 508, 0xaa550000)
+        return bytes(fsinfo)
+
+    def _write_dir(self, f, node, parent_cluster):
+        entries = []
+        if node is not self.root:
+            entries.append(node.dir_entry(b'.          '))
+            entries.append(node.dir_entry(b'..         ', parent_cluster))
+        for child in node.children.values():
+            entries.extend(child.lfn_entries())
+            entries.append(child.dir_entry())
+        f.seek(self._cluster_offset(node.cluster))
+        f.write(b''.join(entries))
+        for child in node.children.values():
+            if child.is_dir:
+                self._write_dir(f, child, 0 if node is self.root
+                                else node.cluster)
+            elif child.size:
+                f.seek(self._cluster_offset(child.cluster))
+                with open(child.src, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+
+    def _write(self):
+        cache = default_cache()
+        if cache:
+            key = self.cache_key
+            if cache.get(key, self._path):
+                self.dirty = False
+                return
+
+        chains = []
+        next_cluster = self._layout(self.root, self.RootCluster, chains)
+        used_clusters = next_cluster - self.RootCluster
+        if used_clusters > self.num_clusters:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), self._path)
+        default_scratch().reserve(
+            (self.ReservedSectors + self.NumFats * self.fat_sectors +
+             used_clusters * self.sectors_per_cluster) * self.SectorSize
+        )
+
+        fat = [0x0ffffff8, self.EndOfChain]
+        for (start, length) in chains:
+            fat.extend(range(start + 1, start + length))
+            fat.append(self.EndOfChain)
+        fat = struct.pack(f'<{len(fat)}I', *fat)
+
+        volume_id = int(self.timestamp) & 0xffffffff
+        boot_sector = self._boot_sector(volume_id)
+        fsinfo = self._fsinfo_sector(
+            self.num_clusters - used_clusters, next_cluster
+        )
+        with open(self._path, 'wb') as f:
+            f.truncate(self.total_sectors * self.SectorSize)
+            for sector in (0, self.BackupBootSector):
+                f.seek(sector * self.SectorSize)
+                f.write(boot_sector)
+                f.write(fsinfo)
+            for fat_idx in range(self.NumFats):
+                sector = self.ReservedSectors + fat_idx * self.fat_sectors
+                f.seek(sector * self.SectorSize)
+                f.write(fat)
+            self._write_dir(f, self.root, 0)
+        self.dirty = False
+        if cache:
+            cache.put(key, self._path)
 
 
 class EfiBootableIsoImage:
+    '''
+    An ISO image booting eltorito_img, kept in the scratch space until
+    close() or the end of a with block.
+    '''
     def __init__(self, eltorito_img):
-        with tempfile.TemporaryDirectory() as iso_root:
+        scratch = default_scratch()
+        self._file = scratch.file(
+            os.stat(eltorito_img.path).st_blocks * 512, suffix='.iso'
+        )
+        self.path = self._file.path
+
+        cache = default_cache()
+        if cache:
+            eltorito_key = getattr(eltorito_img, 'cache_key', None)
+            if eltorito_key is None:
+                eltorito_key = file_digest(eltorito_img.path)
+            key = ArtifactCache.key(
+                type(self).__name__, tool_version(['xorriso', '-version']),
+                eltorito_key,
+            )
+            if cache.get(key, self.path):
+                return
+
+        with scratch.directory() as iso_root:
             eltorito_iso_root = 'boot'
             eltorito_iso_path = os.path.join(eltorito_iso_root, 'efi.img')
             eltorito_local_root = os.path.join(iso_root, eltorito_iso_root)
             eltorito_local_path = os.path.join(iso_root, eltorito_iso_path)
 
             os.makedirs(eltorito_local_root)
-            shutil.copyfile(eltorito_img.path, eltorito_local_path)
-
-            with tempfile.NamedTemporaryFile(delete=False) as f:
-                self.path = f.name
+            copy_sparse(eltorito_img.path, eltorito_local_path)
 
             subprocess.check_call(
                 [
@@ -81,21 +398,81 @@ class EfiBootableIsoImage:
                     '-no-emul-boot', '-o', self.path, iso_root
                 ]
             )
+        if cache:
+            cache.put(key, self.path)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
-        os.unlink(self.path)
+    def __exit__(self, *args):
+        self.close()
 
 
 class GrubShellBootableIsoImage(EfiBootableIsoImage):
     def __init__(self, efi_arch, shim_path, grub_path):
-        efi_img = FatFsImage(64)
-        efi_img.makedirs(os.path.join('EFI', 'BOOT'))
         removable_media_path = os.path.join(
             'EFI', 'BOOT', 'BOOT%s.EFI' % (efi_arch.upper())
         )
         grub_dest = os.path.join(
             'EFI', 'BOOT', 'GRUB%s.EFI' % (efi_arch.upper())
         )
-        efi_img.insert_file(shim_path, removable_media_path)
-        efi_img.insert_file(grub_path, grub_dest)
-        super().__init__(efi_img)
+        # Only needed until it is part of the ISO
+        with FatFsImage(64) as efi_img:
+            efi_img.makedirs(os.path.join('EFI', 'BOOT'))
+            efi_img.insert_file(shim_path, removable_media_path)
+            efi_img.insert_file(grub_path, grub_dest)
+            super().__init__(efi_img)
+
+
+class EfiBootDirectory:
+    '''
+    Boot media as a plain directory in the scratch space, to be exposed
+    to the guest with QemuCommand.add_directory() rather than built into
+    an image. Files are hard linked where possible and copied otherwise,
+    so they stay valid even if their source goes away. The directory is
+    removed by close(), or at the end of a with block.
+    '''
+    def __init__(self):
+        self._dir = default_scratch().directory()
+        self.path = self._dir.name
+
+    def makedirs(self, dir):
+        os.makedirs(os.path.join(self.path, dir), exist_ok=True)
+
+    def insert_file(self, src, dest):
+        dest = os.path.join(self.path, dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            default_scratch().reserve(os.path.getsize(src))
+            shutil.copyfile(src, dest)
+
+    def close(self):
+        self._dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GrubShellBootDirectory(EfiBootDirectory):
+    '''
+    The same files as on a GrubShellBootableIsoImage, for tests that do
+    not need to boot through El Torito.
+    '''
+    def __init__(self, efi_arch, shim_path, grub_path):
+        super().__init__()
+        self.makedirs(os.path.join('EFI', 'BOOT'))
+        self.insert_file(
+            shim_path,
+            os.path.join('EFI', 'BOOT', 'BOOT%s.EFI' % (efi_arch.upper())),
+        )
+        self.insert_file(
+            grub_path,
+            os.path.join('EFI', 'BOOT', 'GRUB%s.EFI' % (efi_arch.upper())),
+        )
@@ -0,0 +1,164 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+
+from UEFI.Cache import file_digest
+
+# Searched in this order, the first image of a name wins
+FIRMWARE_DIRS = [
+    '/usr/share/OVMF',
+    '/usr/share/AAVMF',
+    '/usr/share/qemu-efi-riscv64',
+    '/usr/share/pve-edk2-firmware',
+    '/usr/share/pve-edk2-firmware/legacy',
+]
+
+FamilyArch = {
+    'OVMF': 'x86_64',
+    'OVMF32': 'i386',
+    'AAVMF': 'aarch64',
+    'AAVMF32': 'arm',
+    'RISCV_VIRT': 'riscv64',
+}
+
+# Like OVMF_CODE_4M.secboot.fd, OVMF_SEV_4M.fd or AAVMF_VARS.ms.fd
+ImageName = re.compile(
+    r'^(?P<family>%s)' % '|'.join(sorted(FamilyArch, reverse=True)) +
+    r'(?:_(?P<platform>SEV|TDX|CVM))?'
+    r'(?:_(?P<role>CODE|VARS))?'
+    r'(?:_(?P<size>4M))?'
+    r'(?:\.(?P<variant>[a-z]+))?\.fd$'
+)
+
+_default_catalog = None
+
+
+def image_name(family, platform, role, size, variant):
+    '''
+    File name of the image with these properties, as used for the key of
+    a FirmwareImage.
+    '''
+    parts = [family]
+    if platform:
+        parts.append(platform)
+    if role != 'unified':
+        parts.append(role.upper())
+    if size:
+        parts.append(size)
+    name = '_'.join(parts)
+    if variant:
+        name = f'{name}.{variant}'
+    return f'{name}.fd'
+
+
+class FirmwareImage:
+    '''
+    An installed firmware image. Its properties are taken from its name:
+    family (OVMF, AAVMF, ...), platform (None, or SEV, TDX or CVM for
+    confidential VMs), role (code, vars, or unified for images holding
+    both), size (4M, or None for the family's only size, which is 2M for
+    legacy OVMF builds) and variant (None, secboot, ms, snakeoil).
+    '''
+    def __init__(self, path, family, platform, role, size, variant):
+        self.path = path
+        self.family = family
+        self.arch = FamilyArch[family]
+        self.platform = platform
+        self.role = role.lower() if role else 'unified'
+        self.size = size
+        self.variant = variant
+
+    @property
+    def key(self):
+        return (
+            self.family, self.platform, self.role, self.size, self.variant
+        )
+
+    @property
+    def digest(self):
+        return file_digest(self.path)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path!r})'
+
+
+class FirmwareCatalog:
+    '''
+    Index of the firmware images installed in a list of directories, to
+    look them up by their properties, see FirmwareImage, or by content.
+    Building it only lists the directories, content hashes are computed
+    on first use.
+    '''
+    def __init__(self, directories):
+        self.images = []
+        self.index = {}
+        self._by_digest = None
+        for directory in directories:
+            try:
+                entries = sorted(os.scandir(directory), key=lambda e: e.name)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                m = ImageName.match(entry.name)
+                if m is None or not entry.is_file():
+                    continue
+                image = FirmwareImage(entry.path, **m.groupdict())
+                if image.key not in self.index:
+                    self.images.append(image)
+                    self.index[image.key] = image
+
+    def get(self, key):
+        '''
+        The image with key (family, platform, role, size, variant), or
+        None if it is not installed.
+        '''
+        return self.index.get(key)
+
+    def find(self, **properties):
+        '''
+        All images with the given properties, like find(platform='SEV').
+        '''
+        return [
+            image for image in self.images
+            if all(getattr(image, k) == v for (k, v) in properties.items())
+        ]
+
+    def by_digest(self, digest):
+        '''
+        The images with this content, which is given as a SHA-256 hex
+        digest.
+        '''
+        if self._by_digest is None:
+            self._by_digest = {}
+            for image in self.images:
+                self._by_digest.setdefault(image.digest, []).append(image)
+        return self._by_digest.get(digest, [])
+
+
+def default_catalog():
+    '''
+    The catalog of the images in UEFI_FIRMWARE_PATH, a colon separated
+    list of directories (default: FIRMWARE_DIRS).
+    '''
+    global _default_catalog
+    if _default_catalog is None:
+        path = os.environ.get('UEFI_FIRMWARE_PATH')
+        _default_catalog = FirmwareCatalog(
+            path.split(':') if path else FIRMWARE_DIRS
+        )
+    return _default_catalog
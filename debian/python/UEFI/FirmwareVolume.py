@@ -0,0 +1,367 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import lzma
+import mmap
+import struct
+import uuid
+
+EFI_FIRMWARE_FILE_SYSTEM2_GUID = uuid.UUID(
+    '8c8ce578-8a3d-4f1c-9935-896185c32dd3'
+)
+EFI_FIRMWARE_FILE_SYSTEM3_GUID = uuid.UUID(
+    '5473c07a-3dcb-4dca-bd6f-1e9689e7349a'
+)
+LZMA_CUSTOM_DECOMPRESS_GUID = uuid.UUID(
+    'ee4e5898-3914-4259-9d6e-dc7bd79403cf'
+)
+CRC32_GUIDED_SECTION_EXTRACTION_GUID = uuid.UUID(
+    'fc1bcdb0-7d31-49aa-936a-a4600d9dd083'
+)
+
+EFI_FVB2_ERASE_POLARITY = 0x800
+FFS_ATTRIB_LARGE_FILE = 0x01
+EFI_FILE_DATA_VALID = 0x04
+EFI_FILE_DELETED = 0x10
+EFI_GUIDED_SECTION_PROCESSING_REQUIRED = 0x01
+
+FileTypes = {
+    0x01: 'RAW',
+    0x02: 'FREEFORM',
+    0x03: 'SECURITY_CORE',
+    0x04: 'PEI_CORE',
+    0x05: 'DXE_CORE',
+    0x06: 'PEIM',
+    0x07: 'DRIVER',
+    0x08: 'COMBINED_PEIM_DRIVER',
+    0x09: 'APPLICATION',
+    0x0a: 'MM',
+    0x0b: 'FIRMWARE_VOLUME_IMAGE',
+    0x0c: 'COMBINED_MM_DXE',
+    0x0d: 'MM_CORE',
+    0x0e: 'MM_STANDALONE',
+    0x0f: 'MM_CORE_STANDALONE',
+    0xf0: 'FFS_PAD',
+}
+SectionTypes = {
+    0x01: 'COMPRESSION',
+    0x02: 'GUID_DEFINED',
+    0x03: 'DISPOSABLE',
+    0x10: 'PE32',
+    0x11: 'PIC',
+    0x12: 'TE',
+    0x13: 'DXE_DEPEX',
+    0x14: 'VERSION',
+    0x15: 'USER_INTERFACE',
+    0x16: 'COMPATIBILITY16',
+    0x17: 'FIRMWARE_VOLUME_IMAGE',
+    0x18: 'FREEFORM_SUBTYPE_GUID',
+    0x19: 'RAW',
+    0x1b: 'PEI_DEPEX',
+    0x1c: 'MM_DEPEX',
+}
+# Files made of sections
+SectionedFileTypes = set(FileTypes) - {0x01, 0xf0}
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+def _guid(buf, offset):
+    return uuid.UUID(bytes_le=bytes(buf[offset:offset + 16]))
+
+
+def _type_name(names, value):
+    return names.get(value, f'0x{value:02x}')
+
+
+class Section:
+    '''
+    One section of an FFS file. Encapsulation sections have the sections
+    they contain in children; those of compressed sections are parsed
+    from a decompressed copy, everything else refers to the image.
+    '''
+    def __init__(self, offset, section_type, size):
+        self.offset = offset
+        self.type = section_type
+        self.size = size
+        self.guid = None
+        self.name = None
+        self.note = None
+        self.children = []
+        self.volumes = []
+
+    def to_dict(self):
+        d = {
+            'offset': self.offset,
+            'type': _type_name(SectionTypes, self.type),
+            'size': self.size,
+        }
+        for key in ['guid', 'name', 'note']:
+            if getattr(self, key) is not None:
+                d[key] = str(getattr(self, key))
+        if self.children:
+            d['sections'] = [s.to_dict() for s in self.children]
+        if self.volumes:
+            d['volumes'] = [v.to_dict() for v in self.volumes]
+        return d
+
+
+def parse_sections(buf, start, end):
+    '''
+    Parses the sections in buf[start:end]. buf is the mapped image, or the
+    output of a decompressed section, and offsets are relative to it.
+    '''
+    sections = []
+    offset = start
+    while offset + 4 <= end:
+        (size24, section_type) = struct.unpack_from('<3sB', buf, offset)
+        size = int.from_bytes(size24, 'little')
+        header_size = 4
+        if size == 0xffffff:
+            (size,) = struct.unpack_from('<I', buf, offset + 4)
+            header_size = 8
+        if size < header_size or offset + size > end:
+            break
+        section = Section(offset, section_type, size)
+        data_start = offset + header_size
+        data_end = offset + size
+        _parse_section_data(section, buf, data_start, data_end)
+        sections.append(section)
+        offset = _align(offset + size, 4)
+    return sections
+
+
+def _parse_section_data(section, buf, start, end):
+    if section.type == 0x01:
+        (_, compression_type) = struct.unpack_from('<IB', buf, start)
+        if compression_type == 0:
+            section.children = parse_sections(buf, start + 5, end)
+        else:
+            section.note = 'EFI compressed, not decompressed'
+    elif section.type == 0x02:
+        section.guid = _guid(buf, start)
+        (data_offset, attributes) = struct.unpack_from(
+            '<HH', buf, start + 16
+        )
+        data_start = section.offset + data_offset
+        if section.guid == LZMA_CUSTOM_DECOMPRESS_GUID:
+            # The only copy made: decompressed data has to live somewhere
+            data = lzma.decompress(
+                buf[data_start:end], format=lzma.FORMAT_ALONE
+            )
+            section.note = f'LZMA compressed, {len(data)} bytes unpacked'
+            section.children = parse_sections(data, 0, len(data))
+        elif (not attributes & EFI_GUIDED_SECTION_PROCESSING_REQUIRED or
+                section.guid == CRC32_GUIDED_SECTION_EXTRACTION_GUID):
+            section.children = parse_sections(buf, data_start, end)
+        else:
+            section.note = 'unknown encapsulation, not parsed'
+    elif section.type == 0x15:
+        section.name = bytes(buf[start:end]).decode(
+            'UTF-16-LE', errors='replace'
+        ).rstrip('\0')
+    elif section.type == 0x17:
+        section.volumes = find_volumes(buf, start, end)
+    elif section.type == 0x18:
+        section.guid = _guid(buf, start)
+
+
+class FfsFile:
+    def __init__(self, offset, name, file_type, size, header_size):
+        self.offset = offset
+        self.name = name
+        self.type = file_type
+        self.size = size
+        self.header_size = header_size
+        self.sections = []
+
+    def ui_name(self):
+        '''
+        Name from the USER_INTERFACE section, which may be nested.
+        '''
+        pending = list(self.sections)
+        while pending:
+            section = pending.pop(0)
+            if section.name is not None:
+                return section.name
+            pending.extend(section.children)
+        return None
+
+    def volumes(self):
+        pending = list(self.sections)
+        while pending:
+            section = pending.pop(0)
+            yield from section.volumes
+            pending.extend(section.children)
+
+    def to_dict(self):
+        d = {
+            'offset': self.offset,
+            'guid': str(self.name),
+            'type': _type_name(FileTypes, self.type),
+            'size': self.size,
+        }
+        if self.ui_name() is not None:
+            d['name'] = self.ui_name()
+        if self.sections:
+            d['sections'] = [s.to_dict() for s in self.sections]
+        return d
+
+
+class FirmwareVolume:
+    Header = struct.Struct('<16s16sQ4sIHHHBB')
+
+    def __init__(self, buf, offset):
+        (_, fs_guid, self.size, _, self.attributes, header_length, _,
+         ext_offset, _, self.revision) = self.Header.unpack_from(buf, offset)
+        self.offset = offset
+        self.filesystem = uuid.UUID(bytes_le=fs_guid)
+        self.name = None
+        files_start = header_length
+        if ext_offset:
+            self.name = _guid(buf, offset + ext_offset)
+            (ext_size,) = struct.unpack_from(
+                '<I', buf, offset + ext_offset + 16
+            )
+            files_start = ext_offset + ext_size
+        self.erased = 0xff if self.attributes & EFI_FVB2_ERASE_POLARITY \
+            else 0x00
+        self.files = []
+        self.free = 0
+        # Other volumes, like the variable store, have no FFS files
+        if self.filesystem in (EFI_FIRMWARE_FILE_SYSTEM2_GUID,
+                               EFI_FIRMWARE_FILE_SYSTEM3_GUID):
+            self._parse_files(buf, offset + _align(files_start, 8))
+
+    @classmethod
+    def valid_at(cls, buf, offset, end):
+        '''
+        Tells whether there is a firmware volume header at offset, with
+        a valid checksum and fitting before end.
+        '''
+        if offset < 0 or offset + cls.Header.size > end:
+            return False
+        (_, _, size, signature, _, header_length, _, _, _, _) = \
+            cls.Header.unpack_from(buf, offset)
+        if (signature != b'_FVH' or header_length < cls.Header.size or
+                header_length % 2 or offset + size > end or
+                size < header_length):
+            return False
+        words = struct.unpack_from(f'<{header_length // 2}H', buf, offset)
+        return sum(words) & 0xffff == 0
+
+    def _parse_files(self, buf, offset):
+        end = self.offset + self.size
+        while offset + 24 <= end:
+            header = buf[offset:offset + 24]
+            if header.count(self.erased) == len(header):
+                # Free space from here on, or at least up to the next file
+                self.free = end - offset
+                break
+            (name, _, file_type, attributes, size24, state) = \
+                struct.unpack_from('<16sHBB3sB', buf, offset)
+            size = int.from_bytes(size24, 'little')
+            header_size = 24
+            if attributes & FFS_ATTRIB_LARGE_FILE:
+                (size,) = struct.unpack_from('<Q', buf, offset + 24)
+                header_size = 32
+            if size < header_size or offset + size > end:
+                break
+            if self.erased:
+                state = ~state & 0xff
+            if state & EFI_FILE_DATA_VALID and not state & EFI_FILE_DELETED:
+                f = FfsFile(
+                    offset - self.offset, uuid.UUID(bytes_le=name),
+                    file_type, size, header_size,
+                )
+                if file_type in SectionedFileTypes:
+                    f.sections = parse_sections(
+                        buf, offset + header_size, offset + size
+                    )
+                self.files.append(f)
+            offset = _align(offset + size, 8)
+
+    def used(self):
+        return self.size - self.free - self.padding()
+
+    def padding(self):
+        return sum(f.size for f in self.files if f.type == 0xf0)
+
+    def to_dict(self):
+        d = {
+            'offset': self.offset,
+            'filesystem': str(self.filesystem),
+            'size': self.size,
+            'used': self.used(),
+            'free': self.free,
+            'padding': self.padding(),
+            'files': [f.to_dict() for f in self.files],
+        }
+        if self.name is not None:
+            d['name'] = str(self.name)
+        return d
+
+
+def find_volumes(buf, start, end):
+    '''
+    Firmware volumes in buf[start:end], found by their signature and
+    validated by their header checksum.
+    '''
+    volumes = []
+    offset = start
+    while True:
+        offset = buf.find(b'_FVH', offset + 40, end) - 40
+        if offset < start:
+            break
+        if FirmwareVolume.valid_at(buf, offset, end):
+            volume = FirmwareVolume(buf, offset)
+            volumes.append(volume)
+            offset += volume.size
+        else:
+            offset += 1
+    return volumes
+
+
+class FirmwareImage:
+    '''
+    A flash image, like OVMF_CODE.fd, mapped into memory. Use as a context
+    manager, or call close().
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.volumes = find_volumes(self.map, 0, self.size)
+
+    def close(self):
+        self.volumes = []
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'size': self.size,
+            'volumes': [v.to_dict() for v in self.volumes],
+        }
@@ -0,0 +1,232 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from UEFI.Cache import ArtifactCache, tool_version
+from UEFI.Qemu import QemuCommand, QemuEfiFlashSize
+from UEFI.Scratch import default_scratch
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+EFI_ARCHS = ['X64', 'AA64']
+VENDORS = ['Debian', 'Ubuntu']
+TOOLS = ['openssl', 'qemu-img', 'sbsign', 'xorriso']
+
+EfiArchToGrubArch = {
+    'X64': "x86_64",
+    'AA64': "arm64",
+}
+
+_host_capabilities = None
+
+
+def get_local_grub_path(efi_arch, signed=False):
+    grub_subdir = "%s-efi" % EfiArchToGrubArch[efi_arch.upper()]
+    ext = "efi"
+    if signed:
+        grub_subdir = f"{grub_subdir}-signed"
+        ext = f"{ext}.signed"
+
+    grub_path = os.path.join(
+        os.path.sep, 'usr', 'lib', 'grub',
+        '%s' % (grub_subdir),
+        "" if signed else "monolithic",
+        'grub%s.%s' % (efi_arch.lower(), ext)
+    )
+    return grub_path
+
+
+def get_local_shim_path(efi_arch, signed=False):
+    ext = 'efi'
+    if signed:
+        ext = f"{ext}.signed"
+    shim_path = os.path.join(
+        os.path.sep, 'usr', 'lib', 'shim',
+        'shim%s.%s' % (efi_arch.lower(), ext)
+    )
+    return shim_path
+
+
+def boot_loader_paths():
+    return {
+        get_path(efi_arch, signed)
+        for get_path in [get_local_shim_path, get_local_grub_path]
+        for efi_arch in EFI_ARCHS for signed in [False, True]
+    }
+
+
+def _check_output(argv):
+    return subprocess.check_output(argv).decode().rstrip()
+
+
+def _derives_from(vendor):
+    return subprocess.run(
+        ['dpkg-vendor', '--derives-from', vendor]
+    ).returncode == 0
+
+
+class HostCapabilities:
+    '''
+    What the host offers the tests: its dpkg architecture, the vendors it
+    derives from, the QEMU system emulators and their versions, which of
+    the boot loaders are installed, and the tools that are around.
+    Firmware images are looked up in the FirmwareCatalog instead. Probing
+    runs a few subprocesses, so the result is kept in a small JSON file
+    in the scratch space, or the temporary directory if that is made of
+    memfds, and only probed again once the installed packages or PATH
+    changed. Unlike the artifact cache, this needs no opting in.
+    '''
+    # Bump whenever the probed data changes
+    Version = 2
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def probe(cls):
+        qemu_binaries = sorted({
+            command[0] for command in QemuCommand.Machine_Base_Command.values()
+        })
+        found = {
+            binary: shutil.which(binary)
+            for binary in qemu_binaries + TOOLS
+        }
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            arch = pool.submit(
+                _check_output, ['dpkg', '--print-architecture']
+            )
+            vendors = {
+                vendor: pool.submit(_derives_from, vendor)
+                for vendor in VENDORS
+            }
+            versions = {
+                binary: pool.submit(tool_version, [path, '--version'])
+                for (binary, path) in found.items()
+                if path is not None and binary in qemu_binaries
+            }
+            return cls({
+                'arch': arch.result(),
+                'vendors': [v for (v, f) in vendors.items() if f.result()],
+                'qemu': {
+                    binary: versions[binary].result()
+                    if binary in versions else None
+                    for binary in qemu_binaries
+                },
+                'files': {
+                    path: os.path.exists(path)
+                    for path in sorted(boot_loader_paths())
+                },
+                'tools': {tool: found[tool] for tool in TOOLS},
+            })
+
+    @classmethod
+    def cache_key(cls):
+        try:
+            st = os.stat(DPKG_STATUS)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        return ArtifactCache.key(
+            cls.__name__, cls.Version, stamp, os.environ.get('PATH'),
+        )
+
+    @staticmethod
+    def store_path():
+        directory = default_scratch().path
+        if directory is None:
+            directory = tempfile.gettempdir()
+        return os.path.join(
+            directory, f'pve-edk2-firmware-host-{os.getuid()}.json'
+        )
+
+    @classmethod
+    def load(cls):
+        '''
+        The stored capabilities if they are still current, else freshly
+        probed ones, which are stored for the next run.
+        '''
+        path = cls.store_path()
+        key = cls.cache_key()
+        try:
+            with open(path, 'r') as f:
+                # Only trust what this user wrote, /tmp is shared
+                if os.fstat(f.fileno()).st_uid == os.getuid():
+                    stored = json.load(f)
+                    if stored.get('key') == key:
+                        return cls(stored['data'])
+        except (OSError, ValueError):
+            pass
+        capabilities = cls.probe()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'data': capabilities.data}, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+        return capabilities
+
+    @property
+    def arch(self):
+        return self.data['arch']
+
+    def derives_from(self, vendor):
+        return vendor in self.data['vendors']
+
+    def qemu_version(self, binary):
+        '''
+        First line of the --version output of a qemu-system-* binary, or
+        None if it is not installed.
+        '''
+        return self.data['qemu'].get(binary)
+
+    def has_file(self, path):
+        if path in self.data['files']:
+            return self.data['files'][path]
+        return os.path.exists(path)
+
+    def has_tool(self, tool):
+        if tool in self.data['tools']:
+            return self.data['tools'][tool] is not None
+        return shutil.which(tool) is not None
+
+    def missing(
+            self, machine, variant=None, flash_size=QemuEfiFlashSize.DEFAULT,
+    ):
+        '''
+        What keeps QemuCommand from running machine with the default
+        firmware images for variant and flash_size: the QEMU binary and
+        firmware image that are not installed. Empty if nothing does.
+        '''
+        binary = QemuCommand.Machine_Base_Command[machine][0]
+        missing = [] if self.qemu_version(binary) is not None else [binary]
+        try:
+            QemuCommand.find_firmware(machine, variant, flash_size)
+        except FileNotFoundError as err:
+            missing.append(err.filename)
+        return missing
+
+
+def host_capabilities():
+    global _host_capabilities
+    if _host_capabilities is None:
+        _host_capabilities = HostCapabilities.load()
+    return _host_capabilities
@@ -0,0 +1,127 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import mmap
+import struct
+
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 0x0002
+
+
+class PeImage:
+    '''
+    A PE/COFF image, like an EFI binary, mapped into memory. Use as a
+    context manager, or call close().
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_headers()
+        except (ValueError, struct.error):
+            self.map.close()
+            raise ValueError(f"{path} is not a PE image")
+
+    def _parse_headers(self):
+        m = self.map
+        (pe_offset,) = struct.unpack_from('<I', m, 0x3c)
+        if m[:2] != b'MZ' or m[pe_offset:pe_offset + 4] != b'PE\0\0':
+            raise ValueError()
+        (self.machine, num_sections, _, _, _, opt_size, _) = \
+            struct.unpack_from('<HHIIIHH', m, pe_offset + 4)
+        opt = pe_offset + 24
+        (magic,) = struct.unpack_from('<H', m, opt)
+        self.checksum_offset = opt + 64
+        # Data directory 4, after the PE32 or PE32+ specific fields
+        self.security_dir_offset = \
+            opt + (96 if magic == 0x10b else 112) + 4 * 8
+        (self.cert_offset, self.cert_size) = struct.unpack_from(
+            '<II', m, self.security_dir_offset
+        )
+        self.sections = {}
+        offset = opt + opt_size
+        for _ in range(num_sections):
+            (name, _, _, raw_size, raw_offset) = struct.unpack_from(
+                '<8sIIII', m, offset
+            )
+            name = name.rstrip(b'\0').decode('ascii', errors='replace')
+            self.sections.setdefault(name, (raw_offset, raw_size))
+            offset += 40
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def section(self, name):
+        '''
+        Raw data of the first section called name, or None.
+        '''
+        if name not in self.sections:
+            return None
+        (offset, size) = self.sections[name]
+        return bytes(self.map[offset:offset + size])
+
+    def digest(self, algorithm='sha256'):
+        '''
+        Authenticode hash: everything but the checksum, the certificate
+        table directory entry and the certificate table itself. This
+        equals the hash over the headers and the sections sorted by file
+        offset whenever those are contiguous, as they are in EFI binaries.
+        '''
+        cert_offset = self.cert_offset or len(self.map)
+        h = hashlib.new(algorithm)
+        view = memoryview(self.map)
+        try:
+            for (start, end) in [
+                (0, self.checksum_offset),
+                (self.checksum_offset + 4, self.security_dir_offset),
+                (self.security_dir_offset + 8, cert_offset),
+                (cert_offset + self.cert_size, len(self.map)),
+            ]:
+                h.update(view[start:end])
+        finally:
+            view.release()
+        return h.digest()
+
+    def signatures(self):
+        '''
+        DER encoded PKCS#7 SignedData of every signature in the
+        certificate table.
+        '''
+        result = []
+        offset = self.cert_offset
+        end = self.cert_offset + self.cert_size
+        while self.cert_offset and offset + 8 <= end:
+            (length, _, cert_type) = struct.unpack_from(
+                '<IHH', self.map, offset
+            )
+            if length < 8 or offset + length > end:
+                break
+            if cert_type == WIN_CERT_TYPE_PKCS_SIGNED_DATA:
+                result.append(bytes(self.map[offset + 8:offset + length]))
+            offset += (length + 7) & ~7
+        return result
+
+
+def authenticode_digest(path, algorithm='sha256'):
+    with PeImage(path) as image:
+        return image.digest(algorithm).hex()
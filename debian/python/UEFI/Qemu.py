@@ -17,9 +17,26 @@
 #
 
 import enum
+import errno
+import fcntl
 import os
+import platform
+import re
+import select
+import shlex
 import shutil
-import tempfile
+import subprocess
+import threading
+import time
+
+from UEFI.Cache import ArtifactCache, default_cache, file_digest, tool_version
+from UEFI.Firmware import default_catalog, image_name
+from UEFI.Qmp import QmpClient
+from UEFI.Scratch import default_scratch
+
+WARM_START_TIMEOUT = 300
+# Guest RAM of every instance plus an allowance for QEMU itself, in MiB
+POOL_INSTANCE_MEMORY = 256 + 128
 
 
 class QemuEfiMachine(enum.Enum):
@@ -39,9 +56,27 @@ class QemuEfiVariant(enum.Enum):
 
 class QemuEfiFlashSize(enum.Enum):
     DEFAULT = enum.auto()
+    SIZE_2MB = enum.auto()
     SIZE_4MB = enum.auto()
 
 
+class QemuEfiVarsMode(enum.Enum):
+    COPY = enum.auto()
+    # Needs the scratch space on the template's filesystem, which has to
+    # support reflinks, see PflashParams
+    REFLINK = enum.auto()
+    OVERLAY = enum.auto()
+    # REFLINK where the filesystem supports it, OVERLAY otherwise
+    AUTO = enum.auto()
+
+
+class QemuEfiAccel(enum.Enum):
+    TCG = enum.auto()
+    KVM = enum.auto()
+    # KVM where usable for the machine on this host, TCG otherwise
+    AUTO = enum.auto()
+
+
 class QemuCommand:
     Qemu_Common_Params = [
         '-no-user-config', '-nodefaults',
@@ -68,129 +103,646 @@ class QemuCommand:
             'qemu-system-aarch64', '-cpu', 'cortex-a15',
         ] + Aavmf_Common_Params,
         QemuEfiMachine.OVMF_PC: [
-            'qemu-system-x86_64', '-machine', 'pc,accel=tcg',
+            'qemu-system-x86_64', '-machine', 'pc',
         ] + Ovmf_Common_Params,
         QemuEfiMachine.OVMF_Q35: [
-            'qemu-system-x86_64', '-machine', 'q35,accel=tcg',
+            'qemu-system-x86_64', '-machine', 'q35',
         ] + Ovmf_Common_Params,
         QemuEfiMachine.OVMF32: [
-            'qemu-system-i386', '-machine', 'q35,accel=tcg',
+            'qemu-system-i386', '-machine', 'q35',
         ] + Ovmf_Common_Params,
         QemuEfiMachine.RISCV64: [
             'qemu-system-riscv64',
         ] + RiscV_Common_Params,
     }
+    # Host architectures (as in platform.machine()) that can run a machine
+    # with KVM, and the parameters it needs on top of the base command
+    Machine_Kvm_Host_Arch = {
+        QemuEfiMachine.AAVMF: ['aarch64'],
+        QemuEfiMachine.OVMF_PC: ['x86_64'],
+        QemuEfiMachine.OVMF_Q35: ['x86_64'],
+        QemuEfiMachine.OVMF32: ['x86_64', 'i686'],
+        QemuEfiMachine.RISCV64: ['riscv64'],
+    }
+    Machine_Firmware_Family = {
+        QemuEfiMachine.AAVMF: 'AAVMF',
+        QemuEfiMachine.AAVMF32: 'AAVMF32',
+        QemuEfiMachine.OVMF_PC: 'OVMF',
+        QemuEfiMachine.OVMF_Q35: 'OVMF',
+        QemuEfiMachine.OVMF32: 'OVMF32',
+        QemuEfiMachine.RISCV64: 'RISCV_VIRT',
+    }
+    # Machines that do not support every variant
+    Machine_Variants = {
+        QemuEfiMachine.AAVMF32: [None],
+        QemuEfiMachine.OVMF_PC: [None],
+        QemuEfiMachine.OVMF32: [None, QemuEfiVariant.SECBOOT],
+        QemuEfiMachine.RISCV64: [None],
+    }
+    # Image size (see FirmwareImage) of each flash size a family is built
+    # with, families that are not listed only have one
+    Firmware_Flash_Sizes = {
+        'OVMF': {
+            QemuEfiFlashSize.DEFAULT: '4M',
+            QemuEfiFlashSize.SIZE_2MB: None,
+            QemuEfiFlashSize.SIZE_4MB: '4M',
+        },
+        'OVMF32': {
+            QemuEfiFlashSize.DEFAULT: '4M',
+            QemuEfiFlashSize.SIZE_4MB: '4M',
+        },
+    }
+    # Image variants for code and vars of each variant, in order of
+    # preference. OVMF32 is only built with Secure Boot, and the MS code
+    # is the Secure Boot one, which some distributions do not alias.
+    Variant_Firmware = {
+        None: ([None, 'secboot'], [None]),
+        QemuEfiVariant.MS: (['ms', 'secboot'], ['ms']),
+        QemuEfiVariant.SECBOOT: (['secboot'], [None]),
+        QemuEfiVariant.SNAKEOIL: ([None], ['snakeoil']),
+    }
+    Machine_Kvm_Params = {
+        QemuEfiMachine.AAVMF: [
+            '-cpu', 'host', '-machine', 'gic-version=host',
+        ],
+    }
 
-    def _get_default_flash_paths(self, machine, variant, flash_size):
-        assert(machine in QemuEfiMachine)
-        assert(variant is None or variant in QemuEfiVariant)
-        assert(flash_size in QemuEfiFlashSize)
-
-        code_ext = vars_ext = ''
-        if variant == QemuEfiVariant.MS:
-            code_ext = vars_ext = '.ms'
-        elif variant == QemuEfiVariant.SECBOOT:
-            code_ext = '.secboot'
-        elif variant == QemuEfiVariant.SNAKEOIL:
-            vars_ext = '.snakeoil'
-
-        if machine == QemuEfiMachine.AAVMF:
-            assert(flash_size == QemuEfiFlashSize.DEFAULT)
-            return (
-                f'/usr/share/AAVMF/AAVMF_CODE{code_ext}.fd',
-                f'/usr/share/AAVMF/AAVMF_VARS{code_ext}.fd',
-            )
-        if machine == QemuEfiMachine.AAVMF32:
-            assert(variant is None)
-            assert(flash_size == QemuEfiFlashSize.DEFAULT)
-            return (
-                '/usr/share/AAVMF/AAVMF32_CODE.fd',
-                '/usr/share/AAVMF/AAVMF32_VARS.fd'
-            )
-        if machine == QemuEfiMachine.OVMF32:
-            assert(variant is None or variant in [QemuEfiVariant.SECBOOT])
-            assert(
-                flash_size in [
-                    QemuEfiFlashSize.DEFAULT, QemuEfiFlashSize.SIZE_4MB
-                ]
-            )
-            return (
-                '/usr/share/OVMF/OVMF32_CODE_4M.secboot.fd',
-                '/usr/share/OVMF/OVMF32_VARS_4M.fd',
-            )
-        # Remaining possibilities are OVMF variants
-        if machine == QemuEfiMachine.OVMF_PC:
-            assert(variant is None)
-        if machine == QemuEfiMachine.RISCV64:
-            assert(variant is None)
-            assert(flash_size == QemuEfiFlashSize.DEFAULT)
-            return (
-                '/usr/share/qemu-efi-riscv64/RISCV_VIRT_CODE.fd',
-                '/usr/share/qemu-efi-riscv64/RISCV_VIRT_VARS.fd',
-            )
-        if variant == QemuEfiVariant.SNAKEOIL:
-            # We provide one size - you don't get to pick.
-            assert(flash_size == QemuEfiFlashSize.DEFAULT)
-        size_ext = '_4M'
-        return (
-            f'/usr/share/OVMF/OVMF_CODE{size_ext}{code_ext}.fd',
-            f'/usr/share/OVMF/OVMF_VARS{size_ext}{vars_ext}.fd'
+    @classmethod
+    def kvm_usable(cls, machine):
+        host_archs = cls.Machine_Kvm_Host_Arch.get(machine, [])
+        if platform.machine() not in host_archs:
+            return False
+        return os.access('/dev/kvm', os.R_OK | os.W_OK)
+
+    def _accel_params(self, machine, accel, tcg_thread, tcg_tb_size):
+        if accel is None:
+            accel = os.environ.get('UEFI_QEMU_ACCEL', 'auto')
+            try:
+                accel = QemuEfiAccel[accel.upper()]
+            except KeyError:
+                raise ValueError(
+                    "UEFI_QEMU_ACCEL must be one of %s, not %r" % (
+                        ', '.join(a.name.lower() for a in QemuEfiAccel),
+                        accel,
+                    )
+                ) from None
+        if tcg_thread is None:
+            tcg_thread = os.environ.get('UEFI_QEMU_TCG_THREAD')
+            if tcg_thread not in [None, 'single', 'multi']:
+                raise ValueError(
+                    "UEFI_QEMU_TCG_THREAD must be single or multi, not %r"
+                    % (tcg_thread)
+                )
+        if tcg_tb_size is None and 'UEFI_QEMU_TCG_TB_SIZE' in os.environ:
+            tcg_tb_size = os.environ['UEFI_QEMU_TCG_TB_SIZE']
+            if not tcg_tb_size.isdigit() or int(tcg_tb_size) == 0:
+                raise ValueError(
+                    "UEFI_QEMU_TCG_TB_SIZE must be a positive number of "
+                    "MiB, not %r" % (tcg_tb_size)
+                )
+            tcg_tb_size = int(tcg_tb_size)
+
+        if accel == QemuEfiAccel.AUTO:
+            accel = QemuEfiAccel.TCG
+            if self.kvm_usable(machine):
+                accel = QemuEfiAccel.KVM
+
+        if accel == QemuEfiAccel.KVM:
+            self.accel_settings = {'accel': 'kvm'}
+            return ['-accel', 'kvm'] + self.Machine_Kvm_Params.get(machine, [])
+
+        self.accel_settings = {'accel': 'tcg'}
+        if tcg_thread is not None:
+            self.accel_settings['thread'] = tcg_thread
+        if tcg_tb_size is not None:
+            self.accel_settings['tb-size'] = tcg_tb_size
+        return ['-accel', ','.join(
+            ['tcg'] + [f'{k}={v}' for (k, v) in self.accel_settings.items()
+                       if k != 'accel']
+        )]
+
+    @classmethod
+    def _firmware_candidates(cls, machine, variant, flash_size):
+        '''
+        Catalog keys of the code and vars images for machine, variant and
+        flash_size, each a list in order of preference. Raises a ValueError
+        if the machine is not built with that variant or flash size.
+        '''
+        if machine not in cls.Machine_Firmware_Family:
+            raise ValueError(f"unknown machine {machine}")
+        if variant not in cls.Machine_Variants.get(
+                machine, [None] + list(QemuEfiVariant)
+        ):
+            raise ValueError(f"{machine} has no variant {variant}")
+        family = cls.Machine_Firmware_Family[machine]
+        sizes = cls.Firmware_Flash_Sizes.get(
+            family, {QemuEfiFlashSize.DEFAULT: None}
         )
+        if flash_size not in sizes:
+            raise ValueError(f"{machine} has no flash size {flash_size}")
+
+        (code_variants, vars_variants) = cls.Variant_Firmware[variant]
+        return tuple(
+            [(family, None, role, sizes[flash_size], v) for v in variants]
+            for (role, variants) in [
+                ('code', code_variants), ('vars', vars_variants),
+            ]
+        )
+
+    @classmethod
+    def find_firmware(
+            cls, machine, variant=None, flash_size=QemuEfiFlashSize.DEFAULT,
+            catalog=None,
+    ):
+        '''
+        The code and vars FirmwareImage for machine, variant and
+        flash_size, from catalog (default: default_catalog()). Raises a
+        FileNotFoundError naming the image that is not installed, or a
+        ValueError if there is no such combination.
+        '''
+        if catalog is None:
+            catalog = default_catalog()
+        images = []
+        for keys in cls._firmware_candidates(machine, variant, flash_size):
+            image = next(
+                (catalog.get(k) for k in keys if catalog.get(k)), None
+            )
+            if image is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "firmware image not installed",
+                    image_name(*keys[0]),
+                )
+            images.append(image)
+        return tuple(images)
+
+    @classmethod
+    def firmware_matrix(cls, machines=QemuEfiMachine, catalog=None):
+        '''
+        Every valid (machine, variant, flash_size) whose firmware is
+        installed, leaving out those that end up with the same images as
+        one before.
+        '''
+        seen = set()
+        for machine in machines:
+            for variant in cls.Machine_Variants.get(
+                machine, [None] + list(QemuEfiVariant)
+            ):
+                for flash_size in QemuEfiFlashSize:
+                    try:
+                        images = cls.find_firmware(
+                            machine, variant, flash_size, catalog
+                        )
+                    except (ValueError, FileNotFoundError):
+                        continue
+                    paths = tuple(
+                        os.path.realpath(image.path) for image in images
+                    )
+                    if (machine, paths) in seen:
+                        continue
+                    seen.add((machine, paths))
+                    yield (machine, variant, flash_size)
 
     def __init__(
             self, machine, variant=None,
             code_path=None, vars_template_path=None,
             flash_size=QemuEfiFlashSize.DEFAULT,
+            vars_mode=QemuEfiVarsMode.COPY,
+            accel=None, tcg_thread=None, tcg_tb_size=None,
     ):
-        assert(
+        '''
+        accel selects the accelerator, tcg_thread ('single' or 'multi') and
+        tcg_tb_size (translation block cache size in MiB) tune TCG. Unset
+        ones are taken from UEFI_QEMU_ACCEL (default: AUTO),
+        UEFI_QEMU_TCG_THREAD and UEFI_QEMU_TCG_TB_SIZE. The settings that
+        ended up being used are stored in self.accel_settings.
+        '''
+        assert (
             (code_path and vars_template_path) or
             (not code_path and not vars_template_path)
         )
 
         if not code_path:
-            (code_path, vars_template_path) = self._get_default_flash_paths(
-                machine, variant, flash_size)
+            (code_path, vars_template_path) = [
+                image.path for image in self.find_firmware(
+                    machine, variant, flash_size
+                )
+            ]
 
-        self.pflash = self.PflashParams(code_path, vars_template_path)
-        self.command = self.Machine_Base_Command[machine] + self.pflash.params
+        self.code_path = code_path
+        self.vars_template_path = vars_template_path
+        self.requested_vars_mode = vars_mode
+        self.pflash = self.PflashParams(
+            code_path, vars_template_path, vars_mode
+        )
+        self.base_command = self.Machine_Base_Command[machine] + \
+            self._accel_params(machine, accel, tcg_thread, tcg_tb_size)
+        self.command = self.base_command + self.pflash.params
+        self.warm_started = False
+        self.warm_state = None
+        self.warm_vars = None
+        self.qmp_path = None
+        self.qmp_params = []
 
     def add_disk(self, path):
         self.command = self.command + [
             '-drive', 'file=%s,format=raw' % (path)
         ]
 
+    def add_directory(self, path):
+        '''
+        Expose a host directory, like an EfiBootDirectory, to the guest as
+        a read-only FAT disk through QEMU's vvfat driver.
+        '''
+        path = path.replace(",", ",,")
+        self.command = self.command + [
+            '-drive', f'file=fat:{path},format=raw,readonly=on'
+        ]
+
     def add_oem_string(self, type, string):
         string = string.replace(",", ",,")
         self.command = self.command + [
             '-smbios', f'type={type},value={string}'
         ]
 
+    @property
+    def vars_mode(self):
+        return self.pflash.vars_mode
+
+    def close(self):
+        '''
+        Remove the per-instance files of this command.
+        '''
+        self.pflash.close()
+        for f in (self.warm_state, self.warm_vars):
+            if f is not None:
+                f.close()
+        if self.qmp_path is not None:
+            self.qmp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def enable_qmp(self):
+        '''
+        Have QEMU listen for QMP on a private socket, at self.qmp_path, so
+        that a Console can follow the guest's state. The VM is kept around
+        in the shutdown state after the guest powers off, for the Console
+        to collect statistics before telling QEMU to quit.
+        '''
+        self.qmp_dir = default_scratch().directory()
+        self.qmp_path = os.path.join(self.qmp_dir.name, 'qmp.sock')
+        self.qmp_params = [
+            '-qmp', f'unix:{self.qmp_path},server=on,wait=off',
+            '-no-shutdown',
+        ]
+        self.command = self.command + self.qmp_params
+
+    def _extra_params(self):
+        params = self.command[len(self.base_command + self.pflash.params):]
+        # The QMP socket is specific to this instance
+        n = len(self.qmp_params)
+        for i in range(len(params) - n + 1):
+            if n and params[i:i + n] == self.qmp_params:
+                return params[:i] + params[i + n:]
+        return params
+
+    def _boot_to_shell(self, proc, timeout):
+        deadline = time.monotonic() + timeout
+        output = ''
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for the UEFI shell")
+            (ready, _, _) = select.select([proc.stdout], [], [], remaining)
+            if not ready:
+                continue
+            data = os.read(proc.stdout.fileno(), 4096)
+            if not data:
+                raise RuntimeError("QEMU exited before reaching the shell")
+            output += data.decode('UTF-8', errors='replace')
+            m = re.search('Press .* or any other key to continue', output)
+            if m:
+                proc.stdin.write(b'\x1b\n')
+                proc.stdin.flush()
+                output = output[m.end():]
+                continue
+            if 'Shell> ' in output:
+                return
+
+    def _migration_uri(self, path, incoming=False):
+        '''
+        URI for migrating the VM to the file at path or, if incoming, from
+        it: a file: URI on QEMU 8.2 and later, which added them, and
+        through cat on older ones.
+        '''
+        version = tool_version([self.base_command[0], '--version'])
+        m = re.search(r'version (\d+)\.(\d+)', version)
+        if m and (int(m.group(1)), int(m.group(2))) >= (8, 2):
+            return f'file:{path}'
+        if incoming:
+            return f'exec:cat {shlex.quote(path)}'
+        return f'exec:cat > {shlex.quote(path)}'
+
+    def _save_warm_state(self, state_path, vars_path, timeout):
+        pflash = self.PflashParams(self.code_path, self.vars_template_path)
+        with default_scratch().directory() as tmpdir:
+            qmp_path = os.path.join(tmpdir, 'qmp.sock')
+            proc = subprocess.Popen(
+                self.base_command + pflash.params + self._extra_params() + [
+                    '-qmp', f'unix:{qmp_path},server=on,wait=off',
+                ],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                self._boot_to_shell(proc, timeout)
+                qmp = QmpClient(qmp_path)
+                qmp.execute('stop')
+                qmp.execute('migrate', uri=self._migration_uri(state_path))
+                while True:
+                    status = qmp.execute('query-migrate').get('status')
+                    if status == 'completed':
+                        break
+                    if status in ['failed', 'cancelled']:
+                        raise RuntimeError(f"Saving VM state {status}")
+                    time.sleep(0.05)
+                try:
+                    qmp.execute('quit')
+                except EOFError:
+                    pass
+                qmp.close()
+                proc.wait(timeout=timeout)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+        shutil.copyfile(pflash.varfile_path, vars_path)
+        pflash.close()
+
+    def warm_start(self, timeout=WARM_START_TIMEOUT):
+        '''
+        Switch this command to resume from a VM that has already booted to
+        the UEFI shell prompt, instead of booting the firmware from reset.
+        The first call for a given firmware, vars template and command line
+        boots it once, saves the VM state and vars to the artifact cache,
+        and later instances are started with -incoming from that state.
+        The resumed guest does not print a new prompt until it gets input.
+        '''
+        cache = default_cache()
+        if cache is None:
+            raise RuntimeError(
+                "Warm start needs the artifact cache, which is off: set "
+                "UEFI_MEDIA_CACHE to 'on' or a directory"
+            )
+        key = ArtifactCache.key(
+            'QemuCommand.warm_start',
+            tool_version([self.base_command[0], '--version']),
+            file_digest(self.code_path),
+            file_digest(self.vars_template_path),
+            self.base_command, self._extra_params(),
+        )
+        state_key = ArtifactCache.key(key, 'state')
+        vars_key = ArtifactCache.key(key, 'vars')
+
+        scratch = default_scratch()
+        self.warm_state = scratch.file(suffix='.state')
+        self.warm_vars = scratch.file(
+            os.path.getsize(self.vars_template_path), suffix='.fd'
+        )
+        if not (cache.get(state_key, self.warm_state.path) and
+                cache.get(vars_key, self.warm_vars.path)):
+            self._save_warm_state(
+                self.warm_state.path, self.warm_vars.path, timeout
+            )
+            cache.put(state_key, self.warm_state.path)
+            cache.put(vars_key, self.warm_vars.path)
+
+        extra_params = self._extra_params()
+        self.pflash.close()
+        self.pflash = self.PflashParams(
+            self.code_path, self.warm_vars.path, self.requested_vars_mode
+        )
+        self.command = self.base_command + self.pflash.params + \
+            extra_params + [
+                '-incoming', self._migration_uri(self.warm_state.path, True),
+            ] + self.qmp_params
+        self.warm_started = True
+
     class PflashParams:
         '''
         Used to generate the appropriate -pflash arguments for QEMU. Mostly
-        used as a fancy way to generate a per-instance vars file and have it
-        be automatically cleaned up when the object is destroyed.
+        used as a fancy way to generate a per-instance vars file in the
+        scratch space and have it cleaned up by close(), or at the latest
+        when the object is destroyed.
+
+        vars_mode selects how the per-instance vars file is created from the
+        template; the strategy actually used is stored in self.vars_mode.
+        Reflinks only work within one filesystem, so REFLINK needs
+        UEFI_SCRATCH_DIR on the filesystem of the template, like btrfs or
+        XFS; with the default scratch space on tmpfs or memfds it always
+        fails, and AUTO falls back to OVERLAY.
         '''
-        def __init__(self, code_path, vars_template_path):
+        FICLONE = 0x40049409
+
+        def __init__(
+                self, code_path, vars_template_path,
+                vars_mode=QemuEfiVarsMode.COPY,
+        ):
             self.params = [
                 '-drive',
                 'file=%s,if=pflash,format=raw,unit=0,readonly=on' %
                 (code_path),
             ]
+            self.vars_mode = None
+            self.varfile = None
             if vars_template_path is None:
                 self.varfile_path = None
                 return
-            with tempfile.NamedTemporaryFile(delete=False) as varfile:
-                self.varfile_path = varfile.name
-                with open(vars_template_path, 'rb') as template:
-                    shutil.copyfileobj(template, varfile)
-                    self.params = self.params + [
-                        '-drive',
-                        'file=%s,if=pflash,format=raw,unit=1,readonly=off' %
-                        (varfile.name)
+            self.varfile = default_scratch().file(
+                os.path.getsize(vars_template_path), suffix='.fd'
+            )
+            self.varfile_path = self.varfile.path
+            self.vars_mode = self._instantiate_vars(
+                vars_template_path, vars_mode
+            )
+            vars_format = 'raw'
+            if self.vars_mode == QemuEfiVarsMode.OVERLAY:
+                vars_format = 'qcow2'
+            self.params = self.params + [
+                '-drive',
+                'file=%s,if=pflash,format=%s,unit=1,readonly=off' %
+                (self.varfile_path, vars_format)
+            ]
+
+        def _instantiate_vars(self, vars_template_path, vars_mode):
+            if vars_mode in [QemuEfiVarsMode.REFLINK, QemuEfiVarsMode.AUTO]:
+                with open(vars_template_path, 'rb') as template, \
+                        open(self.varfile_path, 'wb') as varfile:
+                    try:
+                        fcntl.ioctl(
+                            varfile.fileno(), self.FICLONE, template.fileno()
+                        )
+                        return QemuEfiVarsMode.REFLINK
+                    except OSError as err:
+                        if vars_mode == QemuEfiVarsMode.REFLINK:
+                            raise OSError(
+                                err.errno,
+                                "Cannot reflink the vars template, set "
+                                "UEFI_SCRATCH_DIR to a directory on its "
+                                "filesystem",
+                                self.varfile_path,
+                            ) from err
+            if vars_mode in [QemuEfiVarsMode.OVERLAY, QemuEfiVarsMode.AUTO]:
+                subprocess.check_call(
+                    [
+                        'qemu-img', 'create', '-q', '-f', 'qcow2',
+                        '-b', os.path.abspath(vars_template_path),
+                        '-F', 'raw', self.varfile_path,
                     ]
+                )
+                return QemuEfiVarsMode.OVERLAY
+            with open(vars_template_path, 'rb') as template, \
+                    open(self.varfile_path, 'wb') as varfile:
+                shutil.copyfileobj(template, varfile)
+            return QemuEfiVarsMode.COPY
+
+        def close(self):
+            if self.varfile is not None:
+                self.varfile.close()
+
+
+class QemuInstance:
+    '''
+    A QEMU process started from a QemuCommand with its CPUs stopped (-S),
+    so that everything up to the first guest instruction is done before
+    resume() is called. The serial console is on the stdin and stdout of
+    self.proc, stderr is merged into stdout.
+    '''
+    def __init__(self, qemu_command, timeout=30):
+        # Keeps the per-instance vars file alive
+        self.qemu_command = qemu_command
+        self.tmpdir = default_scratch().directory()
+        qmp_path = os.path.join(self.tmpdir.name, 'qmp.sock')
+        self.proc = subprocess.Popen(
+            qemu_command.command + [
+                '-S', '-qmp', f'unix:{qmp_path},server=on,wait=off',
+            ],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            # QMP only answers once the machine has been created
+            self.qmp = QmpClient(qmp_path, timeout)
+        except BaseException:
+            self.proc.kill()
+            self.proc.wait()
+            self.tmpdir.cleanup()
+            raise
+
+    def resume(self):
+        '''
+        Start the guest CPUs. Returns the QEMU process.
+        '''
+        self.qmp.execute('cont')
+        return self.proc
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout):
+            f.close()
+        self.qmp.close()
+        self.tmpdir.cleanup()
+        self.qemu_command.close()
+
+
+class QemuPool:
+    '''
+    Keeps up to size paused QemuInstances of one configuration ready, and
+    starts a replacement in the background whenever one is taken with
+    get(). factory is called without arguments to create the QemuCommand
+    of each instance, so that every instance gets its own vars file.
+
+    The default size allows one running instance per CPU, within the
+    memory that is available, and can be overridden with
+    UEFI_QEMU_POOL_SIZE.
 
-        def __del__(self):
-            if self.varfile_path is None:
+    A pool only pays off for repeated boots of one configuration, which
+    is what debian/tests/bench.py does with --pool. The tests in shell.py
+    boot every configuration once, so they start their QEMU directly.
+    '''
+    def __init__(self, factory, size=None):
+        self.factory = factory
+        if size is None:
+            size = self.default_size()
+        self.size = size
+        self.ready = []
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._refill, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def default_size():
+        if 'UEFI_QEMU_POOL_SIZE' in os.environ:
+            return int(os.environ['UEFI_QEMU_POOL_SIZE'])
+        size = os.cpu_count() or 1
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) // 1024
+                    size = min(size, available // POOL_INSTANCE_MEMORY)
+        return max(size, 1)
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: self.closed or len(self.ready) < self.size
+                )
+                if self.closed:
+                    return
+            try:
+                instance = QemuInstance(self.factory())
+            except Exception as err:
+                with self.cond:
+                    self.error = err
+                    self.cond.notify_all()
                 return
-            os.unlink(self.varfile_path)
+            with self.cond:
+                if self.closed:
+                    instance.close()
+                    return
+                self.ready.append(instance)
+                self.cond.notify_all()
+
+    def get(self, timeout=None):
+        '''
+        Returns a paused QemuInstance, waiting for one to be started if
+        none is ready. The caller has to close() it when done.
+        '''
+        with self.cond:
+            if not self.cond.wait_for(
+                    lambda: self.ready or self.error, timeout
+            ):
+                raise TimeoutError("No QEMU instance became ready")
+            if not self.ready:
+                raise self.error
+            instance = self.ready.pop(0)
+            self.cond.notify_all()
+            return instance
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            ready = self.ready
+            self.ready = []
+            self.cond.notify_all()
+        self.thread.join()
+        for instance in ready:
+            instance.close()
@@ -0,0 +1,205 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import json
+import os
+import socket
+import time
+
+
+class QmpError(Exception):
+    pass
+
+
+class QmpClient:
+    '''
+    Minimal synchronous client for the QEMU Machine Protocol. Events that
+    arrive while waiting for a command's reply are kept in self.events.
+    '''
+    def __init__(self, path, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.sock.settimeout(timeout)
+        self.reader = self.sock.makefile('r', encoding='UTF-8')
+        self.events = []
+        self.greeting = self._read()
+        self.execute('qmp_capabilities')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise EOFError("QMP connection closed")
+        return json.loads(line)
+
+    def execute(self, command, **arguments):
+        request = {'execute': command}
+        if arguments:
+            request['arguments'] = arguments
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+        while True:
+            msg = self._read()
+            if 'event' in msg:
+                self.events.append(msg)
+                continue
+            if 'error' in msg:
+                raise QmpError(
+                    f"{command}: {msg['error'].get('desc', msg['error'])}"
+                )
+            return msg.get('return')
+
+
+def _thread_cpu_time(tid):
+    '''
+    User plus system CPU time of a thread, in seconds.
+    '''
+    with open(f'/proc/{tid}/stat', 'r') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class AsyncQmpClient:
+    '''
+    QMP client for an asyncio event loop, to be used next to a Console.
+    Events are queued as they arrive, independently of command replies,
+    and can be waited for with next_event(). All events received so far
+    are in self.received.
+    '''
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.replies = asyncio.Queue()
+        self.events = asyncio.Queue()
+        self.received = []
+        self.lock = asyncio.Lock()
+        self.greeting = None
+        self.task = None
+
+    @classmethod
+    async def connect(cls, path, timeout=10):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                (reader, writer) = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        client = cls(reader, writer)
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                raise EOFError("QMP connection closed")
+            client.greeting = json.loads(line)
+            client.task = asyncio.ensure_future(client._dispatch())
+            await asyncio.wait_for(
+                client.execute('qmp_capabilities'), timeout
+            )
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    async def _dispatch(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            msg = json.loads(line)
+            if 'event' in msg:
+                self.received.append(msg)
+                self.events.put_nowait(msg)
+            else:
+                self.replies.put_nowait(msg)
+        # Wakes up everyone waiting, see execute() and next_event()
+        self.replies.put_nowait(None)
+        self.events.put_nowait(None)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def execute(self, command, **arguments):
+        request = {'execute': command}
+        if arguments:
+            request['arguments'] = arguments
+        async with self.lock:
+            self.writer.write(json.dumps(request).encode() + b'\n')
+            await self.writer.drain()
+            msg = await self.replies.get()
+        if msg is None:
+            self.replies.put_nowait(None)
+            raise EOFError("QMP connection closed")
+        if 'error' in msg:
+            raise QmpError(
+                f"{command}: {msg['error'].get('desc', msg['error'])}"
+            )
+        return msg.get('return')
+
+    async def next_event(self):
+        '''
+        Returns the next event, or None once QEMU closed the connection.
+        '''
+        event = await self.events.get()
+        if event is None:
+            self.events.put_nowait(None)
+        return event
+
+    async def quit(self):
+        try:
+            await self.execute('quit')
+        except (EOFError, ConnectionError):
+            # QEMU may exit before it gets to reply
+            pass
+
+    async def system_reset(self):
+        await self.execute('system_reset')
+
+    async def query_status(self):
+        return (await self.execute('query-status'))['status']
+
+    async def stats(self):
+        '''
+        Guest RAM size in bytes and the CPU time each vCPU thread has
+        used, in seconds. With single threaded TCG, all vCPUs share one
+        thread and report the same time.
+        '''
+        memory = await self.execute('query-memory-size-summary')
+        cpus = await self.execute('query-cpus-fast')
+        return {
+            'memory': memory['base-memory'],
+            'vcpu_time': [_thread_cpu_time(c['thread-id']) for c in cpus],
+        }
@@ -0,0 +1,218 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import atexit
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+
+_default_scratch = None
+
+
+def _on_tmpfs(path):
+    path = os.path.realpath(path)
+    (longest, fstype) = (-1, None)
+    with open('/proc/self/mounts', 'r') as f:
+        for line in f:
+            (_, mountpoint, mtype) = line.split()[:3]
+            inside = path == mountpoint or \
+                path.startswith(mountpoint.rstrip('/') + '/')
+            # Later mounts on the same mount point hide earlier ones
+            if inside and len(mountpoint) >= longest:
+                (longest, fstype) = (len(mountpoint), mtype)
+    return fstype == 'tmpfs'
+
+
+def _find_tmpfs(quota):
+    '''
+    A writable tmpfs with room for quota bytes, if there is one.
+    '''
+    for candidate in ['/dev/shm', os.environ.get('XDG_RUNTIME_DIR')]:
+        if not candidate or not os.access(candidate, os.W_OK | os.X_OK):
+            continue
+        st = os.statvfs(candidate)
+        if _on_tmpfs(candidate) and st.f_bavail * st.f_frsize >= quota:
+            return candidate
+    return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchFile:
+    '''
+    A file in a ScratchSpace, handed to other tools by its path. It is
+    removed by close(), when leaving its with block or, as a last resort,
+    when it is garbage collected.
+    '''
+    def __init__(self, space, path, fd=None):
+        self.space = space
+        self.path = path
+        # The memfd holding the content, if it is not in a directory
+        self.fd = fd
+
+    def close(self):
+        if self.path is None:
+            return
+        if self.fd is not None:
+            self.space.memfds.discard(self.fd)
+            os.close(self.fd)
+        else:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ScratchSpace:
+    '''
+    Storage for short-lived test artifacts, like boot media and
+    per-instance vars files: a directory, preferably on tmpfs, or memfds
+    if path is None. All processes using the same directory share a
+    quota of that many bytes, checked whenever space is reserved, so that
+    parallel test runs cannot fill it up. The check and the creation of
+    a file are done under an flock on the directory, so that processes
+    cannot pass the check at the same time.
+
+    Every process keeps its files in a subdirectory of its own that is
+    removed when it exits. Those left behind by processes that died are
+    removed by the next process to set up the same scratch space.
+    '''
+    def __init__(self, path, quota):
+        self.path = path
+        self.quota = quota
+        self.memfds = set()
+        self.dir = None
+        if path is not None:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            self._prune()
+            self.dir = tempfile.mkdtemp(dir=path, prefix=f'{os.getpid()}-')
+            atexit.register(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def _prune(self):
+        for entry in os.scandir(self.path):
+            pid = entry.name.partition('-')[0]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def usage(self):
+        total = sum(os.fstat(fd).st_blocks * 512 for fd in self.memfds)
+        if self.path is not None:
+            for (dirpath, _, filenames) in os.walk(self.path):
+                for name in filenames:
+                    try:
+                        st = os.lstat(os.path.join(dirpath, name))
+                    except FileNotFoundError:
+                        continue
+                    total += st.st_blocks * 512
+        return total
+
+    @contextlib.contextmanager
+    def _locked(self):
+        if self.path is None:
+            # memfds are private to this process
+            yield
+            return
+        fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _check_quota(self, size):
+        if self.usage() + size > self.quota:
+            raise OSError(
+                errno.EDQUOT, os.strerror(errno.EDQUOT), self.path or 'memfd'
+            )
+
+    def reserve(self, size):
+        '''
+        Raises an OSError with EDQUOT unless another size bytes fit into
+        the quota.
+        '''
+        with self._locked():
+            self._check_quota(size)
+
+    def file(self, size=0, suffix=''):
+        '''
+        A new, empty ScratchFile that is going to take up to size bytes.
+        '''
+        with self._locked():
+            self._check_quota(size)
+            if self.dir is None:
+                fd = os.memfd_create(f'scratch{suffix}')
+                self.memfds.add(fd)
+                # Other processes can open it through this process' fd
+                # table
+                return ScratchFile(self, f'/proc/{os.getpid()}/fd/{fd}', fd)
+            (fd, path) = tempfile.mkstemp(dir=self.dir, suffix=suffix)
+            os.close(fd)
+            return ScratchFile(self, path)
+
+    def directory(self):
+        '''
+        A tempfile.TemporaryDirectory within the scratch space, or in the
+        default location if it is made of memfds.
+        '''
+        return tempfile.TemporaryDirectory(dir=self.dir)
+
+
+def default_scratch():
+    '''
+    The scratch space used for test artifacts, set up through
+    UEFI_SCRATCH_DIR (default: a subdirectory of a tmpfs with room for
+    the quota, or else memfds) and UEFI_SCRATCH_QUOTA (in MiB).
+    '''
+    global _default_scratch
+    if _default_scratch is None:
+        quota = os.environ.get('UEFI_SCRATCH_QUOTA', '2048')
+        if not quota.isdigit() or int(quota) == 0:
+            raise ValueError(
+                "UEFI_SCRATCH_QUOTA must be a positive number of MiB, not "
+                f"{quota!r}"
+            )
+        quota = int(quota) << 20
+        name = f'pve-edk2-firmware-scratch-{os.getuid()}'
+        path = os.environ.get('UEFI_SCRATCH_DIR')
+        if path is None:
+            tmpfs = _find_tmpfs(quota)
+            if tmpfs is not None:
+                path = os.path.join(tmpfs, name)
+            elif not hasattr(os, 'memfd_create'):
+                path = os.path.join(tempfile.gettempdir(), name)
+        _default_scratch = ScratchSpace(path, quota)
+    return _default_scratch
@@ -0,0 +1,347 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import struct
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+from UEFI import VarStore
+from UEFI.PeImage import PeImage
+
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+DigestAlgorithms = {
+    '1.3.14.3.2.26': 'sha1',
+    '2.16.840.1.101.3.4.2.1': 'sha256',
+    '2.16.840.1.101.3.4.2.2': 'sha384',
+    '2.16.840.1.101.3.4.2.3': 'sha512',
+}
+
+
+def _der(buf, offset):
+    '''
+    (tag, offset, start, end) of the DER item at offset, where start and
+    end delimit its content.
+    '''
+    tag = buf[offset]
+    length = buf[offset + 1]
+    start = offset + 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(buf[start:start + n], 'big')
+        start += n
+    if start + length > len(buf):
+        raise ValueError("truncated DER item")
+    return (tag, offset, start, start + length)
+
+
+def _der_children(buf, item):
+    (_, _, offset, end) = item
+    children = []
+    while offset < end:
+        child = _der(buf, offset)
+        children.append(child)
+        offset = child[3]
+    return children
+
+
+def _oid(buf, item):
+    data = buf[item[2]:item[3]]
+    parts = [data[0] // 40, data[0] % 40]
+    value = 0
+    for b in data[1:]:
+        value = (value << 7) | (b & 0x7f)
+        if not b & 0x80:
+            parts.append(value)
+            value = 0
+    return '.'.join(str(p) for p in parts)
+
+
+def _algorithm(buf, item):
+    return DigestAlgorithms.get(_oid(buf, _der_children(buf, item)[0]))
+
+
+def _issued_by(cert, issuer):
+    try:
+        cert.verify_directly_issued_by(issuer)
+    except (ValueError, TypeError, InvalidSignature):
+        return False
+    return True
+
+
+class AuthenticodeSignature:
+    '''
+    One PKCS#7 SignedData from the certificate table of a PE image,
+    parsed as far as the firmware looks at it.
+    '''
+    def __init__(self, der):
+        content_info = _der(der, 0)
+        (oid, content) = _der_children(der, content_info)[:2]
+        if _oid(der, oid) != OID_SIGNED_DATA:
+            raise ValueError("not a PKCS#7 SignedData")
+        signed_data = _der_children(der, _der_children(der, content)[0])
+
+        # contentInfo holds the SpcIndirectDataContent with the digest of
+        # the image. The signature covers its content, without the tag
+        # and length.
+        spc = _der_children(der, _der_children(der, signed_data[2])[1])[0]
+        digest_info = _der_children(der, spc)[1]
+        (algorithm, digest) = _der_children(der, digest_info)
+        self.digest_algorithm = _algorithm(der, algorithm)
+        self.digest = der[digest[2]:digest[3]]
+        self.signed_content = der[spc[2]:spc[3]]
+
+        self.certificates = []
+        for item in signed_data[3:-1]:
+            if item[0] == 0xa0:
+                self.certificates = [
+                    x509.load_der_x509_certificate(der[c[1]:c[3]])
+                    for c in _der_children(der, item)
+                ]
+        signer_infos = _der_children(der, signed_data[-1])
+        signer_info = _der_children(der, signer_infos[0])
+        (issuer, serial) = _der_children(der, signer_info[1])
+        self.issuer = der[issuer[1]:issuer[3]]
+        self.serial = int.from_bytes(
+            der[serial[2]:serial[3]], 'big', signed=True
+        )
+        self.signer_digest_algorithm = _algorithm(der, signer_info[2])
+        rest = signer_info[3:]
+        # Without authenticated attributes, the content is signed directly
+        self.signed_data = self.signed_content
+        self.message_digest = None
+        if rest[0][0] == 0xa0:
+            attributes = rest.pop(0)
+            self.signed_data = b'\x31' + der[attributes[1] + 1:attributes[3]]
+            for attribute in _der_children(der, attributes):
+                (attr_oid, values) = _der_children(der, attribute)
+                if _oid(der, attr_oid) == OID_MESSAGE_DIGEST:
+                    value = _der_children(der, values)[0]
+                    self.message_digest = der[value[2]:value[3]]
+        self.encrypted_digest = der[rest[1][2]:rest[1][3]]
+
+    def signer(self):
+        for cert in self.certificates:
+            if cert.issuer.public_bytes() == self.issuer and \
+                    cert.serial_number == self.serial:
+                return cert
+        return None
+
+    def chain(self):
+        '''
+        The signer's certificate and those issuing it, as far as they are
+        included in the signature.
+        '''
+        chain = []
+        cert = self.signer()
+        while cert is not None and cert not in chain:
+            chain.append(cert)
+            cert = next(
+                (c for c in self.certificates
+                 if c != cert and _issued_by(cert, c)),
+                None,
+            )
+        return chain
+
+    def valid(self, image_digest):
+        '''
+        Whether the signature is intact and was made for an image with
+        this Authenticode digest.
+        '''
+        signer = self.signer()
+        if self.digest != image_digest or signer is None or \
+                self.signer_digest_algorithm is None:
+            return False
+        if self.message_digest is not None and self.message_digest != \
+                hashlib.new(
+                    self.signer_digest_algorithm, self.signed_content
+                ).digest():
+            return False
+        key = signer.public_key()
+        algorithm = getattr(hashes, self.signer_digest_algorithm.upper())()
+        try:
+            if isinstance(key, rsa.RSAPublicKey):
+                key.verify(
+                    self.encrypted_digest, self.signed_data,
+                    padding.PKCS1v15(), algorithm,
+                )
+            elif isinstance(key, ec.EllipticCurvePublicKey):
+                key.verify(
+                    self.encrypted_digest, self.signed_data,
+                    ec.ECDSA(algorithm),
+                )
+            else:
+                return False
+        except InvalidSignature:
+            return False
+        return True
+
+
+class SignatureDatabase:
+    '''
+    The certificates and hashes of a signature database, like db or dbx,
+    given as EFI_SIGNATURE_LISTs.
+    '''
+    def __init__(self, data=b''):
+        self.certificates = []
+        self.hashes = set()
+        # Of the TBSCertificate, for revoked certificates
+        self.tbs_hashes = set()
+        self.add(data)
+
+    def add(self, data):
+        for (signature_type, _, signature) in \
+                VarStore.signature_list_entries(data):
+            if signature_type == VarStore.EFI_CERT_X509_GUID:
+                self.certificates.append(
+                    x509.load_der_x509_certificate(signature)
+                )
+            elif signature_type == VarStore.EFI_CERT_SHA256_GUID:
+                self.hashes.add(signature)
+            elif signature_type == VarStore.EFI_CERT_X509_SHA256_GUID:
+                # Followed by the time of revocation, which is ignored
+                self.tbs_hashes.add(signature[:32])
+
+    def extend(self, other):
+        self.certificates.extend(other.certificates)
+        self.hashes |= other.hashes
+        self.tbs_hashes |= other.tbs_hashes
+
+    def trusted_by(self, cert):
+        '''
+        The certificate in the database that is cert or issued it, if any.
+        '''
+        for trusted in self.certificates:
+            if cert == trusted or _issued_by(cert, trusted):
+                return trusted
+        return None
+
+    def revokes(self, cert):
+        return cert in self.certificates or hashlib.sha256(
+            cert.tbs_certificate_bytes
+        ).digest() in self.tbs_hashes
+
+
+class SecureBootPolicy:
+    '''
+    Predicts whether the firmware lets an EFI binary run, without booting
+    a VM. Mirrors the checks of EDK2's DxeImageVerificationLib: the image
+    is rejected if its hash or a certificate of any of its signatures is
+    in dbx, or if any signature does not match the image, and accepted if
+    a signature chains up to a certificate in db or its hash is in db.
+    '''
+    def __init__(self, db, dbx, enforced=True):
+        self.db = db
+        self.dbx = dbx
+        self.enforced = enforced
+
+    @classmethod
+    def from_vars(cls, path, dbx_updates=()):
+        '''
+        The policy of a VARS image, with the content of signed dbx
+        updates, like the shipped DBXUpdate-*.bin, added to its dbx.
+        '''
+        store = VarStore.VarStore(path)
+
+        def data(name):
+            var = store.get(name, VarStore.EFI_IMAGE_SECURITY_DATABASE_GUID)
+            return var.data if var is not None else b''
+
+        dbx = SignatureDatabase(data('dbx'))
+        for update in dbx_updates:
+            dbx.add(VarStore.dbx_update_signature_lists(update))
+        enforced = store.get('PK', VarStore.EFI_GLOBAL_VARIABLE) is not None
+        return cls(SignatureDatabase(data('db')), dbx, enforced)
+
+    def for_shim(self, shim_path):
+        '''
+        The policy shim applies to the binaries it loads, like GRUB: db
+        and dbx plus the certificate (or db) and dbx built into shim. MOK
+        lists and SBAT are not taken into account.
+        '''
+        db = SignatureDatabase()
+        db.extend(self.db)
+        dbx = SignatureDatabase()
+        dbx.extend(self.dbx)
+        with PeImage(shim_path) as image:
+            section = image.section('.vendor_cert')
+        if section:
+            (db_size, dbx_size, db_offset, dbx_offset) = \
+                struct.unpack_from('<IIII', section)
+            vendor_db = section[db_offset:db_offset + db_size]
+            if vendor_db[:1] == b'\x30':
+                db.certificates.append(
+                    x509.load_der_x509_certificate(vendor_db)
+                )
+            else:
+                db.add(vendor_db)
+            dbx.add(section[dbx_offset:dbx_offset + dbx_size])
+        return SecureBootPolicy(db, dbx, self.enforced)
+
+    def check(self, path):
+        '''
+        Returns whether the binary at path would be allowed to run, and
+        why.
+        '''
+        if not self.enforced:
+            return (True, "Secure Boot is not enabled")
+        with PeImage(path) as image:
+            digests = {}
+
+            def digest(algorithm):
+                if algorithm not in digests:
+                    digests[algorithm] = image.digest(algorithm)
+                return digests[algorithm]
+
+            if digest('sha256') in self.dbx.hashes:
+                return (False, "image hash is in dbx")
+            try:
+                signatures = [
+                    AuthenticodeSignature(der) for der in image.signatures()
+                ]
+            except (ValueError, IndexError):
+                return (False, "malformed signature")
+            for signature in signatures:
+                if signature.digest_algorithm is None or \
+                        not signature.valid(
+                            digest(signature.digest_algorithm)
+                        ):
+                    return (False, "signature does not match the image")
+                for cert in signature.chain():
+                    if self.dbx.revokes(cert):
+                        return (
+                            False,
+                            f"certificate {cert.subject.rfc4514_string()} "
+                            "is in dbx"
+                        )
+            for signature in signatures:
+                for cert in signature.chain():
+                    trusted = self.db.trusted_by(cert)
+                    if trusted is not None:
+                        return (
+                            True,
+                            "signature chains up to "
+                            f"{trusted.subject.rfc4514_string()} in db"
+                        )
+            if digest('sha256') in self.db.hashes:
+                return (True, "image hash is in db")
+        if not signatures:
+            return (False, "image is not signed")
+        return (False, "no signature chains up to db")
@@ -16,37 +16,97 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import concurrent.futures
 import os
 import subprocess
-import tempfile
+import threading
 
+from UEFI.Cache import ArtifactCache, default_cache, file_digest, tool_version
+from UEFI.PeImage import authenticode_digest
+from UEFI.Scratch import default_scratch
 
-class SignedBinary:
-    def __init__(self, binary_path, key_path, cert_path, password=None):
-        openssl_password_args = []
-        if password:
-            openssl_password_args = [
-                "-passin", f"pass:{password}"
-            ]
-        with tempfile.NamedTemporaryFile() as keytmp:
+_decrypted_keys = {}
+_decrypted_keys_lock = threading.Lock()
+
+
+def _decrypted_key(key_path, password):
+    '''
+    Path of a passphrase-free copy of a key, decrypted only once per
+    process into the scratch space.
+    '''
+    stamp = (file_digest(key_path), password)
+    with _decrypted_keys_lock:
+        if stamp not in _decrypted_keys:
+            openssl_password_args = []
+            if password:
+                openssl_password_args = [
+                    "-passin", f"pass:{password}"
+                ]
+            keytmp = default_scratch().file(suffix='.key')
             subprocess.check_call(
                 [
                     "openssl", "rsa",
                 ] + openssl_password_args + [
                     "-in", f"{key_path}",
-                    "-out", f"{keytmp.name}",
+                    "-out", f"{keytmp.path}",
                 ]
             )
-            with tempfile.NamedTemporaryFile(delete=False) as f:
-                self.path = f.name
+            _decrypted_keys[stamp] = keytmp
+        return _decrypted_keys[stamp].path
+
+
+class SignedBinary:
+    '''
+    A copy of binary_path signed with the given key, kept in the scratch
+    space until close() or the end of a with block. Signed binaries are
+    kept in the artifact cache, keyed on the binary, certificate and key,
+    so unchanged binaries are never signed again. self.digest is the
+    Authenticode SHA-256 digest of the binary.
+    '''
+    def __init__(self, binary_path, key_path, cert_path, password=None):
+        self._file = default_scratch().file(
+            os.path.getsize(binary_path), suffix='.efi'
+        )
+        self.path = self._file.path
 
+        cache = default_cache()
+        if cache:
+            key = ArtifactCache.key(
+                type(self).__name__, tool_version(['sbsign', '--version']),
+                file_digest(binary_path), file_digest(cert_path),
+                file_digest(key_path),
+            )
+        if not (cache and cache.get(key, self.path)):
             subprocess.check_call(
                 [
-                    "sbsign", "--key", f"{keytmp.name}",
+                    "sbsign",
+                    "--key", f"{_decrypted_key(key_path, password)}",
                     "--cert", f"{cert_path}",
                     binary_path, "--output", f"{self.path}"
                 ]
             )
+            if cache:
+                cache.put(key, self.path)
+        self.digest = authenticode_digest(self.path)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
-    def __del__(self):
-        os.unlink(self.path)
+def sign_binaries(binary_paths, key_path, cert_path, password=None,
+                  jobs=None):
+    '''
+    Sign several binaries with the same key in parallel. Returns their
+    SignedBinary objects, in the same order.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(
+            lambda path: SignedBinary(path, key_path, cert_path, password),
+            binary_paths,
+        ))
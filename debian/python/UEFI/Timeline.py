@@ -0,0 +1,167 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import time
+
+from UEFI.Cache import ArtifactCache, default_cache
+from UEFI.Scratch import default_scratch
+
+
+class BootMilestone:
+    SPAWN = 'spawn'
+    FIRST_OUTPUT = 'first_output'
+    BDS_PROMPT = 'bds_prompt'
+    SHELL_PROMPT = 'shell_prompt'
+    BOOT_LOADER_START = 'boot_loader_start'
+    GRUB_PROMPT = 'grub_prompt'
+    ACCESS_DENIED = 'access_denied'
+    SHUTDOWN_REQUEST = 'shutdown_request'
+    POWER_OFF = 'power_off'
+    EXIT = 'exit'
+
+
+class BootTimeline:
+    '''
+    Records when known milestones show up on a VM's console, relative to
+    the creation of the timeline. Each milestone is recorded only the first
+    time it is marked, and consecutive milestones delimit the boot phases.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.wall_start = time.time()
+        self.start = time.monotonic()
+        self.milestones = []
+        # Free-form details about the run, e.g. the accelerator settings
+        self.info = {}
+
+    def mark(self, milestone):
+        if self.time_of(milestone) is None:
+            self.milestones.append((milestone, time.monotonic() - self.start))
+
+    def time_of(self, milestone):
+        for (name, t) in self.milestones:
+            if name == milestone:
+                return t
+        return None
+
+    def output_received(self, data):
+        if data:
+            self.mark(BootMilestone.FIRST_OUTPUT)
+
+    def phases(self):
+        phases = {}
+        prev = (BootMilestone.SPAWN, 0.0)
+        for (name, t) in self.milestones:
+            if name == BootMilestone.SPAWN:
+                prev = (name, t)
+                continue
+            phases[f'{prev[0]}->{name}'] = t - prev[1]
+            prev = (name, t)
+        return phases
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start': self.wall_start,
+            'info': self.info,
+            'milestones': [
+                {'name': name, 'time': t} for (name, t) in self.milestones
+            ],
+            'phases': self.phases(),
+        }
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.name}.json')
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+        return path
+
+
+class PhaseHistory:
+    '''
+    The boot phases of the last successful runs with the name and the
+    KeyInfo settings of a timeline, kept in the artifact cache.
+    deadlines() derives from them how long a run may take to get past
+    each milestone before it is considered hung.
+    '''
+    # Bump whenever the stored data changes
+    Version = 2
+    # Entries of BootTimeline.info that change how long the phases take:
+    # accelerator settings, whether the VM was resumed from a saved
+    # state, the boot media, whether QMP ends the run and how many tests
+    # run at the same time
+    KeyInfo = ['accel', 'warm_started', 'boot_media', 'qmp', 'jobs']
+    MaxRuns = 20
+    # Runs needed before there are any deadlines
+    MinRuns = 3
+    # A phase may take Factor times as long as in the slowest run seen,
+    # plus Slack seconds
+    Factor = 3
+    Slack = 5.0
+
+    def __init__(self, key, runs=()):
+        self.key = key
+        self.runs = list(runs)
+
+    @classmethod
+    def load(cls, timeline):
+        '''
+        The history for timeline, which must already have the KeyInfo
+        settings that apply to it in info.
+        '''
+        key = ArtifactCache.key(
+            cls.__name__, cls.Version, timeline.name, json.dumps(
+                {k: timeline.info.get(k) for k in cls.KeyInfo},
+                sort_keys=True,
+            ),
+        )
+        runs = []
+        cache = default_cache()
+        if cache:
+            with default_scratch().file(suffix='.json') as f:
+                if cache.get(key, f.path):
+                    with open(f.path, 'r') as g:
+                        runs = json.load(g)
+        return cls(key, runs)
+
+    def record(self, timeline):
+        self.runs = (self.runs + [timeline.phases()])[-self.MaxRuns:]
+        cache = default_cache()
+        if cache:
+            with default_scratch().file(suffix='.json') as f:
+                with open(f.path, 'w') as g:
+                    json.dump(self.runs, g)
+                cache.put(self.key, f.path)
+
+    def deadlines(self):
+        '''
+        Maps each milestone to the seconds the phase after it may take.
+        '''
+        if len(self.runs) < self.MinRuns:
+            return {}
+        slowest = {}
+        for phases in self.runs:
+            for (phase, t) in phases.items():
+                start = phase.split('->')[0]
+                slowest[start] = max(slowest.get(start, 0.0), t)
+        return {
+            milestone: t * self.Factor + self.Slack
+            for (milestone, t) in slowest.items()
+        }
@@ -0,0 +1,478 @@
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import base64
+import datetime
+import functools
+import hashlib
+import os
+import re
+import struct
+import uuid
+
+from cryptography import x509
+
+EFI_SYSTEM_NV_DATA_FV_GUID = uuid.UUID('fff12b8d-7696-4c8b-a985-2747075b4f50')
+EFI_AUTHENTICATED_VARIABLE_GUID = uuid.UUID(
+    'aaf32c78-947b-439a-a180-2e144ec37792'
+)
+EFI_GLOBAL_VARIABLE = uuid.UUID('8be4df61-93ca-11d2-aa0d-00e098032b8c')
+EFI_IMAGE_SECURITY_DATABASE_GUID = uuid.UUID(
+    'd719b2cb-3d3a-4596-a3bc-dad00e67656f'
+)
+EFI_CERT_X509_GUID = uuid.UUID('a5c059a1-94e4-4aa7-87b5-ab155c2bf072')
+EFI_CERT_SHA256_GUID = uuid.UUID('c1c41626-504c-4092-aca9-41f936934328')
+EFI_CERT_X509_SHA256_GUID = uuid.UUID(
+    '3bd2a492-96c0-4079-b420-fcf98ef103ed'
+)
+
+# Signature owners
+OVMF_ENROLL_DEFAULT_KEYS = uuid.UUID('a0baa8a3-041d-48a8-bc87-c36d121b5e3d')
+MICROSOFT_VENDOR = uuid.UUID('77fa9abd-0359-4d32-bd60-28f4e78f784b')
+
+# Certificates enrolled next to the vendor's own by the "vendor" profile,
+# by their names in virt.firmware.efi.certs, in the order virt-fw-vars
+# --enroll-cert enrolls them
+MS_KEK_CERTS = ['MS_KEK_2011', 'MS_KEK_2023']
+MS_DB_CERTS = [
+    'MS_WIN_2011', 'MS_WIN_2023', 'MS_3RD_2011', 'MS_3RD_2023', 'MS_ROM_2023',
+]
+# Only enrolled by the versions of python3-virt-firmware that ship them
+MS_OPTIONAL_CERTS = {'MS_ROM_2023'}
+
+# Enrolled variables are never dated earlier than this, like virt-fw-vars
+INITIAL_TIME = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+
+EFI_VARIABLE_NON_VOLATILE = 0x01
+EFI_VARIABLE_BOOTSERVICE_ACCESS = 0x02
+EFI_VARIABLE_RUNTIME_ACCESS = 0x04
+EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS = 0x20
+
+SECURE_BOOT_VARIABLE_ATTRIBUTES = (
+    EFI_VARIABLE_NON_VOLATILE |
+    EFI_VARIABLE_BOOTSERVICE_ACCESS |
+    EFI_VARIABLE_RUNTIME_ACCESS |
+    EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS
+)
+
+PemRegex = re.compile(
+    rb'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----', re.DOTALL
+)
+
+
+def efi_time(t):
+    '''
+    EFI_TIME for a datetime in UTC, or all zeroes for None.
+    '''
+    if t is None:
+        return bytes(16)
+    return struct.pack(
+        '<HBBBBBxIhBx', t.year, t.month, t.day, t.hour, t.minute, t.second,
+        t.microsecond * 1000, 0, 0,
+    )
+
+
+def parse_efi_time(data):
+    '''
+    The datetime of an EFI_TIME, or None if it is all zeroes.
+    '''
+    (year, month, day, hour, minute, second, nanosecond, _, _) = \
+        struct.unpack_from('<HBBBBBxIhBx', data)
+    if not year:
+        return None
+    return datetime.datetime(
+        year, month, day, hour, minute, second, nanosecond // 1000,
+        tzinfo=datetime.timezone.utc,
+    )
+
+
+def not_valid_before(der):
+    cert = x509.load_der_x509_certificate(der)
+    try:
+        return cert.not_valid_before_utc
+    except AttributeError:
+        # cryptography before 42.0
+        return cert.not_valid_before.replace(tzinfo=datetime.timezone.utc)
+
+
+def pem_der(pem, source):
+    '''
+    DER encoding of the certificates in PEM data read from source. Text
+    around them, like the output of openssl x509 -text, is skipped.
+    '''
+    certs = tuple(base64.b64decode(m) for m in PemRegex.findall(pem))
+    if not certs:
+        raise ValueError(f"no certificate in {source}")
+    return certs
+
+
+@functools.lru_cache(maxsize=None)
+def pem_certificates(path):
+    '''
+    DER encoding of the certificates in a PEM file.
+    '''
+    with open(path, 'rb') as f:
+        return pem_der(f.read(), path)
+
+
+def virt_firmware_certificates(names):
+    '''
+    DER encoding of the certificates python3-virt-firmware ships under
+    names in virt.firmware.efi.certs. Up to 24.x those are paths of PEM
+    files, later versions name resources for certs.load_cert(). Optional
+    certificates the installed version does not know are left out.
+    '''
+    try:
+        from virt.firmware.efi import certs
+    except ImportError as err:
+        raise RuntimeError(
+            "python3-virt-firmware is needed for the Microsoft certificates"
+        ) from err
+    ders = []
+    for name in names:
+        ref = getattr(certs, name, None)
+        if ref is None:
+            if name in MS_OPTIONAL_CERTS:
+                continue
+            raise RuntimeError(
+                f"python3-virt-firmware has no certificate {name}"
+            )
+        try:
+            if hasattr(certs, 'load_cert'):
+                pem = certs.load_cert(ref)
+            else:
+                with open(ref, 'rb') as f:
+                    pem = f.read()
+        except FileNotFoundError as err:
+            raise FileNotFoundError(
+                err.errno,
+                f"certificate {name} of python3-virt-firmware is missing",
+                err.filename,
+            ) from err
+        ders.extend(pem_der(pem, ref))
+    return ders
+
+
+def x509_signature_list(owner, der):
+    '''
+    EFI_SIGNATURE_LIST holding a single X.509 certificate.
+    '''
+    signature_size = 16 + len(der)
+    return struct.pack(
+        '<16sIII', EFI_CERT_X509_GUID.bytes_le, 28 + signature_size, 0,
+        signature_size,
+    ) + owner.bytes_le + der
+
+
+def sha256_signature_list(owner, digests):
+    '''
+    EFI_SIGNATURE_LIST holding SHA-256 digests.
+    '''
+    return struct.pack(
+        '<16sIII', EFI_CERT_SHA256_GUID.bytes_le, 28 + 48 * len(digests), 0,
+        48,
+    ) + b''.join(owner.bytes_le + digest for digest in digests)
+
+
+def check_signature_lists(data):
+    offset = 0
+    while offset < len(data):
+        (list_size, header_size, signature_size) = struct.unpack_from(
+            '<III', data, offset + 16
+        )
+        if list_size < 28 + header_size or signature_size == 0 or \
+                (list_size - 28 - header_size) % signature_size != 0:
+            raise ValueError("malformed signature list")
+        offset += list_size
+    if offset != len(data):
+        raise ValueError("truncated signature list")
+
+
+def signature_list_entries(data):
+    '''
+    (signature type, owner, signature data) of every signature in a
+    sequence of EFI_SIGNATURE_LISTs.
+    '''
+    check_signature_lists(data)
+    offset = 0
+    while offset < len(data):
+        (signature_type, list_size, header_size, signature_size) = \
+            struct.unpack_from('<16sIII', data, offset)
+        signature_type = uuid.UUID(bytes_le=signature_type)
+        start = offset + 28 + header_size
+        for sig in range(start, offset + list_size, signature_size):
+            owner = uuid.UUID(bytes_le=data[sig:sig + 16])
+            yield (signature_type, owner, data[sig + 16:sig + signature_size])
+        offset += list_size
+
+
+@functools.lru_cache(maxsize=None)
+def dbx_update(path):
+    '''
+    The time stamp and the signature lists of a signed dbx update, like
+    the DBXUpdate-*.bin files published by Microsoft: an
+    EFI_VARIABLE_AUTHENTICATION_2 header, followed by the new content of
+    dbx.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    # EFI_TIME, then a WIN_CERTIFICATE_UEFI_GUID whose dwLength covers
+    # the whole certificate
+    (cert_length, revision, cert_type) = struct.unpack_from('<IHH', data, 16)
+    if revision != 0x0200 or cert_type != 0x0ef1:
+        raise ValueError(f"{path} is not an authenticated variable update")
+    signature_lists = data[16 + cert_length:]
+    check_signature_lists(signature_lists)
+    return (parse_efi_time(data), signature_lists)
+
+
+def dbx_update_signature_lists(path):
+    return dbx_update(path)[1]
+
+
+class EfiVariable:
+    # AUTHENTICATED_VARIABLE_HEADER
+    Header = struct.Struct('<HBBIQ16sIII16s')
+    StartId = 0x55aa
+    VarAdded = 0x3f
+    VarInDeletedTransition = 0xfe
+
+    def __init__(
+            self, name, guid, attributes, data, timestamp=bytes(16),
+            monotonic_count=0, pubkey_index=0,
+    ):
+        self.name = name
+        self.guid = guid
+        self.attributes = attributes
+        self.data = data
+        self.timestamp = timestamp
+        self.monotonic_count = monotonic_count
+        self.pubkey_index = pubkey_index
+
+    @classmethod
+    def parse(cls, buf, offset):
+        '''
+        Returns the variable at offset (None if it is deleted) and the
+        offset of the next one, or (None, None) at the end of the store.
+        '''
+        if len(buf) - offset < cls.Header.size:
+            return (None, None)
+        (start_id, state, _, attributes, monotonic_count, timestamp,
+         pubkey_index, name_size, data_size, guid) = \
+            cls.Header.unpack_from(buf, offset)
+        if start_id != cls.StartId:
+            return (None, None)
+        name_start = offset + cls.Header.size
+        data_start = name_start + name_size
+        next_offset = (data_start + data_size + 3) & ~3
+        if state not in (cls.VarAdded,
+                         cls.VarAdded & cls.VarInDeletedTransition):
+            return (None, next_offset)
+        name = bytes(buf[name_start:data_start]).decode('UTF-16-LE')
+        var = cls(
+            name.rstrip('\0'), uuid.UUID(bytes_le=bytes(guid)), attributes,
+            bytes(buf[data_start:data_start + data_size]),
+            bytes(timestamp), monotonic_count, pubkey_index,
+        )
+        return (var, next_offset)
+
+    def serialize(self):
+        name = (self.name + '\0').encode('UTF-16-LE')
+        var = self.Header.pack(
+            self.StartId, self.VarAdded, 0, self.attributes,
+            self.monotonic_count, self.timestamp, self.pubkey_index,
+            len(name), len(self.data), self.guid.bytes_le,
+        ) + name + self.data
+        return var + b'\xff' * (-len(var) % 4)
+
+
+class VarStore:
+    '''
+    The authenticated variable store in the NV data firmware volume of a
+    VARS image. Everything outside the variable store, like the fault
+    tolerant write areas, is written back untouched, and the variables
+    are written back compacted and sorted by name, as virt-fw-vars writes
+    them.
+    '''
+    # VARIABLE_STORE_HEADER
+    StoreHeader = struct.Struct('<16sIBBHI')
+    StoreFormatted = 0x5a
+    StoreHealthy = 0xfe
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.image = f.read()
+        (guid, length, signature, _, header_length) = struct.unpack_from(
+            '<16sQ4sIH', self.image, 16
+        )
+        if signature != b'_FVH' or \
+                uuid.UUID(bytes_le=guid) != EFI_SYSTEM_NV_DATA_FV_GUID:
+            raise ValueError(f"{path} has no NV data firmware volume")
+        self.store_offset = header_length
+        (store_guid, self.store_size, store_format, store_state, _, _) = \
+            self.StoreHeader.unpack_from(self.image, self.store_offset)
+        if uuid.UUID(bytes_le=store_guid) != \
+                EFI_AUTHENTICATED_VARIABLE_GUID:
+            raise ValueError(f"{path} has no authenticated variable store")
+        if store_format != self.StoreFormatted or \
+                store_state != self.StoreHealthy:
+            raise ValueError(f"variable store of {path} is not healthy")
+
+        self.variables = []
+        store = memoryview(self.image)[
+            :self.store_offset + self.store_size
+        ]
+        offset = self.store_offset + self.StoreHeader.size
+        while offset is not None:
+            (var, offset) = EfiVariable.parse(store, offset)
+            if var is not None:
+                self.set(var)
+
+    def copy(self):
+        other = object.__new__(VarStore)
+        other.__dict__.update(self.__dict__)
+        other.variables = list(self.variables)
+        return other
+
+    def get(self, name, guid):
+        for var in self.variables:
+            if var.name == name and var.guid == guid:
+                return var
+        return None
+
+    def set(self, var):
+        for (i, old) in enumerate(self.variables):
+            if old.name == var.name and old.guid == var.guid:
+                self.variables[i] = var
+                return
+        self.variables.append(var)
+
+    def to_bytes(self):
+        start = self.store_offset + self.StoreHeader.size
+        end = self.store_offset + self.store_size
+        data = b''.join(
+            var.serialize()
+            for var in sorted(self.variables, key=lambda v: v.name)
+        )
+        if len(data) > end - start:
+            raise ValueError("variable store is full")
+        return b''.join([
+            self.image[:start],
+            data,
+            b'\xff' * (end - start - len(data)),
+            self.image[end:],
+        ])
+
+    def write(self, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(tmp, path)
+
+
+class Enrollment:
+    '''
+    Secure Boot keys to enroll: the signature lists for PK, KEK, db and
+    dbx. The variables are dated like virt-fw-vars dates them, by the
+    newest certificate they hold but no earlier than INITIAL_TIME, except
+    for a dbx taken from a signed update, which keeps the update's time.
+    Secure Boot itself is left as the template has it.
+    '''
+    def __init__(self, pk=b'', kek=b'', db=b'', dbx=b'', dbx_time=None):
+        self.pk = pk
+        self.kek = kek
+        self.db = db
+        self.dbx = dbx
+        self.dbx_time = dbx_time
+
+    @staticmethod
+    def signature_list_time(data):
+        return max([INITIAL_TIME] + [
+            not_valid_before(der)
+            for (signature_type, _, der) in signature_list_entries(data)
+            if signature_type == EFI_CERT_X509_GUID
+        ])
+
+    def apply(self, store):
+        for (name, guid, data) in [
+                ('PK', EFI_GLOBAL_VARIABLE, self.pk),
+                ('KEK', EFI_GLOBAL_VARIABLE, self.kek),
+                ('db', EFI_IMAGE_SECURITY_DATABASE_GUID, self.db),
+                ('dbx', EFI_IMAGE_SECURITY_DATABASE_GUID, self.dbx),
+        ]:
+            if not data:
+                continue
+            if name == 'dbx' and self.dbx_time is not None:
+                t = self.dbx_time
+            else:
+                t = self.signature_list_time(data)
+            store.set(EfiVariable(
+                name, guid, SECURE_BOOT_VARIABLE_ATTRIBUTES, data, efi_time(t)
+            ))
+
+
+def vendor_enrollment(cert_path, dbx_path=None):
+    '''
+    The vendor's PK/KEK certificate as PK and KEK, plus the Microsoft KEK
+    and db certificates of python3-virt-firmware and a dbx update, or a
+    placeholder dbx without one. Equivalent to virt-fw-vars --enroll-cert
+    and --set-dbx.
+    '''
+    def signature_lists(owner, ders):
+        return b''.join(x509_signature_list(owner, der) for der in ders)
+
+    vendor = signature_lists(OVMF_ENROLL_DEFAULT_KEYS, pem_certificates(
+        cert_path
+    ))
+    if dbx_path:
+        (dbx_time, dbx) = dbx_update(dbx_path)
+    else:
+        # The hash of nothing, which matches no image
+        (dbx_time, dbx) = (None, sha256_signature_list(
+            OVMF_ENROLL_DEFAULT_KEYS, [hashlib.sha256(b'').digest()]
+        ))
+    return Enrollment(
+        pk=vendor,
+        kek=vendor + signature_lists(
+            MICROSOFT_VENDOR, virt_firmware_certificates(MS_KEK_CERTS)
+        ),
+        db=signature_lists(
+            MICROSOFT_VENDOR, virt_firmware_certificates(MS_DB_CERTS)
+        ),
+        dbx=dbx,
+        dbx_time=dbx_time,
+    )
+
+
+def snakeoil_enrollment(cert_path):
+    '''
+    A single certificate as PK, KEK and db.
+    '''
+    (der,) = pem_certificates(cert_path)
+    esl = x509_signature_list(OVMF_ENROLL_DEFAULT_KEYS, der)
+    return Enrollment(pk=esl, kek=esl, db=esl)
+
+
+def enroll_variants(template_path, variants):
+    '''
+    Write a pre-enrolled copy of a VARS template for each (output path,
+    Enrollment) in variants, parsing the template only once.
+    '''
+    template = VarStore(template_path)
+    for (output_path, enrollment) in variants:
+        store = template.copy()
+        enrollment.apply(store)
+        store.write(output_path)
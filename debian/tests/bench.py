@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Boot latency benchmark for the installed firmware images. Boots every
+# machine/variant/flash size combination to the UEFI shell a number of
+# times, reports the median and p95 time to the shell prompt and time to
+# shut down, and optionally compares them against a saved baseline.
+#
+# Usage: PYTHONPATH=./debian/python python3 debian/tests/bench.py --help
+
+import argparse
+import functools
+import json
+import math
+import statistics
+import sys
+
+from UEFI.Console import run_console, shell_flow
+from UEFI.Qemu import QemuEfiAccel, QemuEfiMachine
+from UEFI.Timeline import BootMilestone, BootTimeline
+from UEFI import Qemu
+
+BOOT_TIMEOUT = 120
+METRICS = ['time_to_shell', 'time_to_shutdown']
+
+
+def combination_name(machine, variant, flash_size):
+    variant_name = variant.name if variant else 'NONE'
+    return f'{machine.name}/{variant_name}/{flash_size.name}'
+
+
+def boot_once(machine, variant, flash_size, timeout, pool=None,
+              **accel_args):
+    '''
+    Boot a fresh QemuCommand, or resume a paused instance from pool.
+    '''
+    timeline = BootTimeline(combination_name(machine, variant, flash_size))
+    if pool is None:
+        q = Qemu.QemuCommand(
+            machine, variant=variant, flash_size=flash_size, **accel_args
+        )
+        result = run_console(
+            q.command, shell_flow(), timeout, timeline=timeline
+        )
+    else:
+        instance = pool.get()
+        q = instance.qemu_command
+        try:
+            result = run_console(
+                q.command, shell_flow(), timeout, timeline=timeline,
+                process=instance.resume(),
+            )
+        finally:
+            instance.close()
+    if result.exitstatus != 0:
+        raise RuntimeError(f"QEMU exited with status {result.exitstatus}")
+
+    shell = timeline.time_of(BootMilestone.SHELL_PROMPT)
+    return q.accel_settings, {
+        'time_to_shell': shell - timeline.time_of(BootMilestone.SPAWN),
+        'time_to_shutdown': (
+            timeline.time_of(BootMilestone.EXIT) -
+            timeline.time_of(BootMilestone.SHUTDOWN_REQUEST)
+        ),
+    }
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'median': statistics.median(ordered),
+        'p95': ordered[math.ceil(0.95 * len(ordered)) - 1],
+        'samples': samples,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns a list of (name, metric, baseline median, current median) for
+    every metric whose median got slower by more than threshold percent.
+    '''
+    regressions = []
+    for (name, metrics) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        if baseline[name].get('accel') != metrics.get('accel'):
+            sys.stderr.write(
+                f"WARNING: {name} was run with different accelerator "
+                "settings than the baseline\n"
+            )
+        for metric in METRICS:
+            old = baseline[name][metric]['median']
+            new = metrics[metric]['median']
+            if new > old * (1 + threshold / 100):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure firmware boot latency under QEMU.'
+    )
+    parser.add_argument(
+        '-n', '--runs', type=int, default=5,
+        help='boots per combination (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-m', '--machine', action='append',
+        choices=[m.name for m in QemuEfiMachine],
+        help='only benchmark this machine, may be given more than once',
+    )
+    parser.add_argument(
+        '-o', '--output', help='save the results as JSON to this file',
+    )
+    parser.add_argument(
+        '-b', '--baseline', help='compare against results saved earlier',
+    )
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=10.0,
+        help='allowed slowdown of a median in percent (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--accel', choices=[a.name.lower() for a in QemuEfiAccel],
+        help='accelerator to use (default: UEFI_QEMU_ACCEL or auto)',
+    )
+    parser.add_argument(
+        '--tcg-thread', choices=['single', 'multi'],
+        help='TCG threading mode',
+    )
+    parser.add_argument(
+        '--tcg-tb-size', type=int,
+        help='TCG translation block cache size in MiB',
+    )
+    parser.add_argument(
+        '--pool', action='store_true',
+        help='resume pre-started, paused instances instead of starting '
+             'QEMU for every boot, measuring the firmware only',
+    )
+    parser.add_argument(
+        '--timeout', type=int, default=BOOT_TIMEOUT,
+        help='timeout per console interaction in seconds',
+    )
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error('--runs must be at least 1')
+
+    machines = list(QemuEfiMachine)
+    if args.machine:
+        machines = [QemuEfiMachine[m] for m in args.machine]
+
+    accel_arg = QemuEfiAccel[args.accel.upper()] if args.accel else None
+
+    results = {}
+    matrix = Qemu.QemuCommand.firmware_matrix(machines)
+    for (machine, variant, flash_size) in matrix:
+        name = combination_name(machine, variant, flash_size)
+        samples = {metric: [] for metric in METRICS}
+        accel_args = {
+            'accel': accel_arg, 'tcg_thread': args.tcg_thread,
+            'tcg_tb_size': args.tcg_tb_size,
+        }
+        pool = None
+        if args.pool:
+            pool = Qemu.QemuPool(
+                functools.partial(
+                    Qemu.QemuCommand, machine, variant=variant,
+                    flash_size=flash_size, **accel_args
+                ),
+                min(args.runs, Qemu.QemuPool.default_size()),
+            )
+        try:
+            for _ in range(args.runs):
+                (accel, sample) = boot_once(
+                    machine, variant, flash_size, args.timeout, pool,
+                    **accel_args
+                )
+                for metric in METRICS:
+                    samples[metric].append(sample[metric])
+        finally:
+            if pool is not None:
+                pool.close()
+        results[name] = {
+            metric: summarize(samples[metric]) for metric in METRICS
+        }
+        results[name]['accel'] = accel
+        sys.stdout.write(
+            "%s: shell median %.3fs p95 %.3fs, "
+            "shutdown median %.3fs p95 %.3fs\n" % (
+                name,
+                results[name]['time_to_shell']['median'],
+                results[name]['time_to_shell']['p95'],
+                results[name]['time_to_shutdown']['median'],
+                results[name]['time_to_shutdown']['p95'],
+            )
+        )
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': args.runs, 'results': results}, f, indent=2)
+            f.write('\n')
+
+    ret = 0
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        for (name, metric, old, new) in compare(
+                results, baseline, args.threshold
+        ):
+            sys.stdout.write(
+                "REGRESSION: %s %s median %.3fs -> %.3fs (+%.1f%%)\n" %
+                (name, metric, old, new, (new / old - 1) * 100)
+            )
+            ret = 1
+    sys.exit(ret)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Proxmox Server Solutions GmbH
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Offline checks of SecureBootPolicy, the oracle predicting whether the
+# firmware runs a binary, against binaries signed with the snakeoil key
+# and VARS images with the snakeoil key enrolled.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from UEFI import VarStore
+from UEFI.PeImage import authenticode_digest
+from UEFI.SecureBoot import SecureBootPolicy
+from UEFI.SignedBinary import SignedBinary
+
+DEBIAN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAKEOIL_KEY = os.path.join(DEBIAN_DIR, 'PkKek-1-snakeoil.key')
+SNAKEOIL_CERT = os.path.join(DEBIAN_DIR, 'PkKek-1-snakeoil.pem')
+SNAKEOIL_PASSWORD = 'snakeoil'
+VARS_TEMPLATE = os.path.join(DEBIAN_DIR, 'legacy-2M-builds', 'OVMF_VARS.fd')
+
+# Whether to skip the tests needing sbsign and openssl if they are not
+# installed. Under autopkgtest, the test dependencies provide them.
+SKIP_MISSING = os.environ.get(
+    'SHELL_TEST_SKIP_MISSING', '0' if 'AUTOPKGTEST_TMP' in os.environ else '1'
+) == '1'
+
+
+def write_efi_binary(path):
+    '''
+    Write a minimal x86-64 EFI application: the headers and a single
+    .text section returning EFI_SUCCESS.
+    '''
+    image = bytearray(0x400)
+    image[:2] = b'MZ'
+    struct.pack_into('<I', image, 0x3c, 0x40)
+    image[0x40:0x44] = b'PE\0\0'
+    # COFF header: x86-64, one section, a PE32+ optional header with 16
+    # data directories, executable
+    struct.pack_into(
+        '<HHIIIHH', image, 0x44, 0x8664, 1, 0, 0, 0, 112 + 16 * 8, 0x22
+    )
+    # PE32+ optional header, for an EFI application at 0x1000 in memory
+    struct.pack_into(
+        '<HBBIIIIIQIIHHHHHHIIIIHHQQQQII', image, 0x58,
+        0x20b, 0, 0, 0x200, 0, 0, 0x1000, 0x1000, 0, 0x1000, 0x200,
+        0, 0, 0, 0, 0, 0, 0, 0x2000, 0x200, 0, 10, 0,
+        0x100000, 0x1000, 0x100000, 0x1000, 0, 16,
+    )
+    struct.pack_into(
+        '<8sIIIIIIHHI', image, 0x58 + 112 + 16 * 8,
+        b'.text', 0x200, 0x1000, 0x200, 0x200, 0, 0, 0, 0, 0x60000020,
+    )
+    # xor eax, eax; ret
+    image[0x200:0x203] = b'\x31\xc0\xc3'
+    with open(path, 'wb') as f:
+        f.write(image)
+
+
+class SecureBootPolicyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.unsigned = cls.path('unsigned.efi')
+        write_efi_binary(cls.unsigned)
+        cls.snakeoil_vars = cls.path('OVMF_VARS.snakeoil.fd')
+        VarStore.enroll_variants(VARS_TEMPLATE, [
+            (cls.snakeoil_vars,
+             VarStore.snakeoil_enrollment(SNAKEOIL_CERT)),
+        ])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.tmpdir.name, name)
+
+    def signed_copy(self, name):
+        '''
+        A copy of the unsigned binary signed by sbsign with the snakeoil
+        key, at name in the temporary directory.
+        '''
+        missing = [t for t in ['openssl', 'sbsign'] if not shutil.which(t)]
+        if missing:
+            msg = "missing on this host: %s" % (', '.join(missing))
+            if SKIP_MISSING:
+                self.skipTest(msg)
+            self.fail(msg)
+        with SignedBinary(
+                self.unsigned, SNAKEOIL_KEY, SNAKEOIL_CERT, SNAKEOIL_PASSWORD,
+        ) as signed:
+            shutil.copyfile(signed.path, self.path(name))
+        return self.path(name)
+
+    def test_signed(self):
+        policy = SecureBootPolicy.from_vars(self.snakeoil_vars)
+        (allowed, reason) = policy.check(self.signed_copy('signed.efi'))
+        self.assertTrue(allowed, reason)
+        self.assertIn("in db", reason)
+
+    def test_tampered(self):
+        tampered = self.signed_copy('tampered.efi')
+        with open(tampered, 'r+b') as f:
+            # Turn xor eax, eax into xor eax, ebx
+            f.seek(0x201)
+            f.write(b'\xd8')
+        policy = SecureBootPolicy.from_vars(self.snakeoil_vars)
+        self.assertEqual(
+            (False, "signature does not match the image"),
+            policy.check(tampered),
+        )
+
+    def test_unsigned(self):
+        policy = SecureBootPolicy.from_vars(self.snakeoil_vars)
+        self.assertEqual(
+            (False, "image is not signed"), policy.check(self.unsigned)
+        )
+
+    def test_dbx_hash(self):
+        signed = self.signed_copy('revoked.efi')
+        revoked_vars = self.path('OVMF_VARS.revoked.fd')
+        store = VarStore.VarStore(self.snakeoil_vars)
+        VarStore.Enrollment(dbx=VarStore.sha256_signature_list(
+            VarStore.OVMF_ENROLL_DEFAULT_KEYS,
+            [bytes.fromhex(authenticode_digest(signed))],
+        )).apply(store)
+        store.write(revoked_vars)
+        policy = SecureBootPolicy.from_vars(revoked_vars)
+        self.assertEqual(
+            (False, "image hash is in dbx"), policy.check(signed)
+        )
+
+    def test_not_enrolled(self):
+        policy = SecureBootPolicy.from_vars(VARS_TEMPLATE)
+        self.assertEqual(
+            (True, "Secure Boot is not enabled"), policy.check(self.unsigned)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
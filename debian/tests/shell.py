@@ -17,56 +17,84 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import enum
+import argparse
+import concurrent.futures
 import os
-import pexpect
 import subprocess
 import sys
 import time
 import unittest
 
-from UEFI.Filesystems import GrubShellBootableIsoImage
-from UEFI.SignedBinary import SignedBinary
+from UEFI.Console import (
+    ConsoleError, Watchdog, run_console, secure_boot_flow, shell_flow
+)
+from UEFI.Filesystems import (
+    GrubShellBootableIsoImage, GrubShellBootDirectory
+)
+from UEFI.Host import (
+    get_local_grub_path, get_local_shim_path, host_capabilities
+)
+from UEFI.SignedBinary import sign_binaries
 from UEFI.Qemu import QemuEfiMachine, QemuEfiVariant, QemuEfiFlashSize
+from UEFI.Timeline import BootTimeline, PhaseHistory
 from UEFI import Qemu
 
-DPKG_ARCH = subprocess.check_output(
-    ['dpkg', '--print-architecture']
-).decode().rstrip()
-
-EfiArchToGrubArch = {
-    'X64': "x86_64",
-    'AA64': "arm64",
-}
+HOST = host_capabilities()
+DPKG_ARCH = HOST.arch
 
 TEST_TIMEOUT = 120
 
-
-def get_local_grub_path(efi_arch, signed=False):
-    grub_subdir = "%s-efi" % EfiArchToGrubArch[efi_arch.upper()]
-    ext = "efi"
-    if signed:
-        grub_subdir = f"{grub_subdir}-signed"
-        ext = f"{ext}.signed"
-
-    grub_path = os.path.join(
-        os.path.sep, 'usr', 'lib', 'grub',
-        '%s' % (grub_subdir),
-        "" if signed else "monolithic",
-        'grub%s.%s' % (efi_arch.lower(), ext)
+# Seconds without console output after which a test fails, 0 to wait
+# for TEST_TIMEOUT. How long the firmware stays silent depends on the
+# accelerator and the load, so unset, it is DEFAULT_INACTIVITY_TIMEOUT
+# only on KVM and once PhaseHistory has learned deadlines for the test,
+# and off otherwise.
+INACTIVITY_TIMEOUT = os.environ.get('SHELL_TEST_INACTIVITY_TIMEOUT')
+if INACTIVITY_TIMEOUT is not None:
+    INACTIVITY_TIMEOUT = int(INACTIVITY_TIMEOUT)
+DEFAULT_INACTIVITY_TIMEOUT = 30
+
+# Fail tests as soon as a boot phase takes much longer than in past
+# runs, see PhaseHistory. The history is kept in the artifact cache,
+# which is only on by default under autopkgtest, see default_cache().
+LEARN_DEADLINES = os.environ.get('SHELL_TEST_LEARN_DEADLINES', '1') == '1'
+
+# Resume plain boot-to-shell tests from a saved VM state, see
+# QemuCommand.warm_start(). Needs the artifact cache, so outside of
+# autopkgtest also UEFI_MEDIA_CACHE, see default_cache().
+WARM_START = os.environ.get('SHELL_TEST_WARM_START', '0') == '1'
+
+# Follow the VM over QMP, to finish as soon as the guest powers off and
+# to fail right away if QEMU stops it, see Console
+USE_QMP = os.environ.get('SHELL_TEST_QMP', '1') == '1'
+
+# How to provide shim and GRUB to the guest: 'iso' builds a bootable
+# ISO image, so that the tests cover a real El Torito boot, 'directory'
+# exposes them with QEMU's vvfat, which is quicker to set up for local
+# runs that do not need that
+BOOT_MEDIA = os.environ.get('SHELL_TEST_BOOT_MEDIA', 'iso')
+if BOOT_MEDIA not in ['iso', 'directory']:
+    raise ValueError(
+        "SHELL_TEST_BOOT_MEDIA must be iso or directory, not %r" % BOOT_MEDIA
     )
-    return grub_path
 
-
-def get_local_shim_path(efi_arch, signed=False):
-    ext = 'efi'
-    if signed:
-        ext = f"{ext}.signed"
-    shim_path = os.path.join(
-        os.path.sep, 'usr', 'lib', 'shim',
-        'shim%s.%s' % (efi_arch.lower(), ext)
+# Whether to skip tests needing something the host does not have, like
+# a QEMU binary, firmware image or tool. Under autopkgtest, the test
+# dependencies provide all of those, so anything missing is an error.
+SKIP_MISSING = os.environ.get(
+    'SHELL_TEST_SKIP_MISSING', '0' if 'AUTOPKGTEST_TMP' in os.environ else '1'
+) == '1'
+
+# How many tests run at the same time, see run_parallel(), which slows
+# each of them down
+JOBS = int(os.environ.get('SHELL_TEST_JOBS', '1')) or os.cpu_count()
+
+# Where to write the per-test boot timelines, if anywhere
+TIMELINE_DIR = os.environ.get('SHELL_TEST_TIMELINE_DIR')
+if TIMELINE_DIR is None and 'AUTOPKGTEST_ARTIFACTS' in os.environ:
+    TIMELINE_DIR = os.path.join(
+        os.environ['AUTOPKGTEST_ARTIFACTS'], 'timelines'
     )
-    return shim_path
 
 
 class BootToShellTest(unittest.TestCase):
@@ -74,235 +102,341 @@ class BootToShellTest(unittest.TestCase):
 
     def setUp(self):
         self.startTime = time.time()
+        self.timeline = BootTimeline(self.id())
+        self.timeline.info['jobs'] = JOBS
 
     def tearDown(self):
         t = time.time() - self.startTime
         sys.stdout.write("%s runtime: %.3fs\n" % (self.id(), t))
+        if TIMELINE_DIR and self.timeline.milestones:
+            self.timeline.write(TIMELINE_DIR)
+
+    def require(self, files=(), tools=(), **machine):
+        '''
+        Skip the test, or fail it unless SKIP_MISSING, if the host lacks
+        any of files or tools, or what QemuCommand needs for the machine,
+        variant and flash_size given as keywords. Checked against the host
+        capabilities, so before anything gets spawned.
+        '''
+        missing = HOST.missing(**machine) if machine else []
+        missing += [path for path in files if not HOST.has_file(path)]
+        missing += [tool for tool in tools if not HOST.has_tool(tool)]
+        if not missing:
+            return
+        msg = "missing on this host: %s" % (', '.join(missing))
+        if SKIP_MISSING:
+            self.skipTest(msg)
+        self.fail(msg)
+
+    def qemu_command(
+            self, machine, variant=None, flash_size=QemuEfiFlashSize.DEFAULT,
+    ):
+        self.require(machine=machine, variant=variant, flash_size=flash_size)
+        return Qemu.QemuCommand(
+            machine, variant=variant, flash_size=flash_size
+        )
 
-    def run_cmd_check_shell(self, cmd):
-        child = pexpect.spawn(' '.join(cmd), encoding='UTF-8')
+    def run_qemu_check_shell(self, q):
+        if WARM_START:
+            q.warm_start()
+        if USE_QMP:
+            q.enable_qmp()
+        self.timeline.info['accel'] = q.accel_settings
+        self.timeline.info['warm_started'] = q.warm_started
+        self.timeline.info['qmp'] = USE_QMP
+        self.run_cmd_check_shell(
+            q.command, warm=q.warm_started, qmp_path=q.qmp_path
+        )
 
-        if self.debug:
-            child.logfile = sys.stdout
-        try:
-            while True:
-                i = child.expect(
-                    [
-                        'Press .* or any other key to continue',
-                        'Shell> '
-                    ],
-                    timeout=TEST_TIMEOUT,
-                )
-                if i == 0:
-                    child.sendline('\x1b')
-                    continue
-                if i == 1:
-                    child.sendline('reset -s\r')
-                    continue
-        except pexpect.EOF:
-            child.close()
-            if child.exitstatus != 0:
-                self.fail("ERROR: exit code %d\n" % (child.exitstatus))
-        except pexpect.TIMEOUT as err:
-            self.fail("%s\n" % (err))
-
-    def run_cmd_check_secure_boot(self, cmd, efiarch, should_verify):
-        class State(enum.Enum):
-            PRE_EXEC = 1
-            POST_EXEC = 2
-
-        child = pexpect.spawn(' '.join(cmd), encoding='UTF-8')
-
-        if self.debug:
-            child.logfile = sys.stdout
+    def run_qemu_check_secure_boot(self, q, efiarch, should_verify):
+        if USE_QMP:
+            q.enable_qmp()
+        self.timeline.info['accel'] = q.accel_settings
+        self.timeline.info['qmp'] = USE_QMP
+        self.run_cmd_check_secure_boot(
+            q.command, efiarch, should_verify, qmp_path=q.qmp_path
+        )
+
+    def add_grub_shell_media(self, q, efi_arch, shim_path, grub_path):
+        '''
+        Attach boot media with shim and GRUB to q, in the form selected by
+        BOOT_MEDIA. The caller has to close the returned media when done.
+        '''
+        self.require(
+            files=[shim_path, grub_path],
+            tools=['xorriso'] if BOOT_MEDIA == 'iso' else [],
+        )
+        self.timeline.info['boot_media'] = BOOT_MEDIA
+        if BOOT_MEDIA == 'iso':
+            media = GrubShellBootableIsoImage(efi_arch, shim_path, grub_path)
+            q.add_disk(media.path)
+        else:
+            media = GrubShellBootDirectory(efi_arch, shim_path, grub_path)
+            q.add_directory(media.path)
+        return media
+
+    def run_console(self, cmd, flow, initial_input=None, qmp_path=None):
+        history = PhaseHistory.load(self.timeline) if LEARN_DEADLINES \
+            else None
+        deadlines = history.deadlines() if history is not None else {}
+        inactivity = INACTIVITY_TIMEOUT
+        if inactivity is None:
+            accel = self.timeline.info.get('accel') or {}
+            if deadlines and accel.get('accel') == 'kvm':
+                inactivity = DEFAULT_INACTIVITY_TIMEOUT
+            else:
+                inactivity = 0
+        watchdog = Watchdog(inactivity, deadlines)
         try:
-            state = State.PRE_EXEC
-            while True:
-                i = child.expect(
-                    [
-                        'Press .* or any other key to continue',
-                        'Shell> ',
-                        "FS0:\\\\> ",
-                        'grub> ',
-                        'Command Error Status: Access Denied',
-                    ],
-                    timeout=TEST_TIMEOUT,
-                )
-                if i == 0:
-                    child.sendline('\x1b')
-                    continue
-                if i == 1:
-                    child.sendline('fs0:\r')
-                    continue
-                if i == 2:
-                    if state == State.PRE_EXEC:
-                        child.sendline(f'\\efi\\boot\\boot{efiarch}.efi\r')
-                        state = State.POST_EXEC
-                    elif state == State.POST_EXEC:
-                        child.sendline('reset -s\r')
-                    continue
-                if i == 3:
-                    child.sendline('halt\r')
-                    verified = True
-                    continue
-                if i == 4:
-                    verified = False
-                    continue
-        except pexpect.EOF:
-            child.close()
-            if child.exitstatus != 0:
-                self.fail("ERROR: exit code %d\n" % (child.exitstatus))
-        except pexpect.TIMEOUT as err:
-            self.fail("%s\n" % (err))
-        self.assertEqual(should_verify, verified)
+            result = run_console(
+                cmd, flow, TEST_TIMEOUT,
+                logfile=sys.stdout if self.debug else None,
+                timeline=self.timeline,
+                initial_input=initial_input,
+                qmp_path=qmp_path,
+                watchdog=watchdog,
+            )
+        except ConsoleError as err:
+            self.fail("%s: %s\n" % (err.reason, err))
+        if result.exitstatus != 0:
+            self.fail("ERROR: exit code %s\n" % (result.exitstatus))
+        if history is not None:
+            history.record(self.timeline)
+        return result
+
+    def run_cmd_check_shell(self, cmd, warm=False, qmp_path=None):
+        # A resumed shell is sitting at its prompt, make it print another
+        self.run_console(
+            cmd, shell_flow(), '\r' if warm else None, qmp_path
+        )
+
+    def run_cmd_check_secure_boot(
+            self, cmd, efiarch, should_verify, qmp_path=None,
+    ):
+        result = self.run_console(
+            cmd, secure_boot_flow(efiarch), qmp_path=qmp_path
+        )
+        self.assertEqual(should_verify, result.values.get('verified'))
 
     def test_aavmf(self):
-        q = Qemu.QemuCommand(QemuEfiMachine.AAVMF)
-        self.run_cmd_check_shell(q.command)
+        q = self.qemu_command(QemuEfiMachine.AAVMF)
+        self.run_qemu_check_shell(q)
 
     @unittest.skipUnless(DPKG_ARCH == 'arm64', "Requires grub-efi-arm64")
     @unittest.skipUnless(
-        subprocess.run(
-            ['dpkg-vendor', '--derives-from', 'Ubuntu']
-        ).returncode == 0,
+        HOST.derives_from('Ubuntu'),
         "Debian does not provide a signed shim for arm64, see #992073"
     )
     def test_aavmf_ms_secure_boot_signed(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.AAVMF,
             variant=QemuEfiVariant.MS,
         )
         grub = get_local_grub_path('AA64', signed=True)
         shim = get_local_shim_path('AA64', signed=True)
-        iso = GrubShellBootableIsoImage('AA64', shim, grub)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'aa64', True)
+        with self.add_grub_shell_media(q, 'AA64', shim, grub):
+            self.run_qemu_check_secure_boot(q, 'aa64', True)
 
     @unittest.skipUnless(DPKG_ARCH == 'arm64', "Requires grub-efi-arm64")
     def test_aavmf_ms_secure_boot_unsigned(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.AAVMF,
             variant=QemuEfiVariant.MS,
         )
         grub = get_local_grub_path('AA64', signed=False)
         shim = get_local_shim_path('AA64', signed=False)
-        iso = GrubShellBootableIsoImage('AA64', shim, grub)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'aa64', False)
+        with self.add_grub_shell_media(q, 'AA64', shim, grub):
+            self.run_qemu_check_secure_boot(q, 'aa64', False)
 
     def test_aavmf_snakeoil(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.AAVMF,
             variant=QemuEfiVariant.SNAKEOIL,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     def test_aavmf32(self):
-        q = Qemu.QemuCommand(QemuEfiMachine.AAVMF32)
-        self.run_cmd_check_shell(q.command)
+        q = self.qemu_command(QemuEfiMachine.AAVMF32)
+        self.run_qemu_check_shell(q)
 
     def test_ovmf_4m(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     def test_ovmf_4m_secboot(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.SECBOOT,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     def test_ovmf_4m_ms(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.MS,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     def test_ovmf_snakeoil(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.SNAKEOIL,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     @unittest.skipUnless(DPKG_ARCH == 'amd64', "amd64-only")
     def test_ovmf_4m_ms_secure_boot_signed(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.MS,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
         grub = get_local_grub_path('X64', signed=True)
         shim = get_local_shim_path('X64', signed=True)
-        iso = GrubShellBootableIsoImage('X64', shim, grub)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'x64', True)
+        with self.add_grub_shell_media(q, 'X64', shim, grub):
+            self.run_qemu_check_secure_boot(q, 'x64', True)
 
     @unittest.skipUnless(DPKG_ARCH == 'amd64', "amd64-only")
     def test_ovmf_4m_ms_secure_boot_unsigned(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.MS,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
         grub = get_local_grub_path('X64', signed=False)
         shim = get_local_shim_path('X64', signed=False)
-        iso = GrubShellBootableIsoImage('X64', shim, grub)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'x64', False)
+        with self.add_grub_shell_media(q, 'X64', shim, grub):
+            self.run_qemu_check_secure_boot(q, 'x64', False)
 
     @unittest.skipUnless(DPKG_ARCH == 'amd64', "amd64-only")
     def test_ovmf_snakeoil_secure_boot_signed(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.SNAKEOIL,
         )
-        shim = SignedBinary(
+        unsigned = [
             get_local_shim_path('X64', signed=False),
-            "/usr/share/ovmf/PkKek-1-snakeoil.key",
-            "/usr/share/ovmf/PkKek-1-snakeoil.pem",
-            "snakeoil",
-        )
-        grub = SignedBinary(
             get_local_grub_path('X64', signed=False),
+        ]
+        self.require(files=unsigned, tools=['openssl', 'sbsign'])
+        (shim, grub) = sign_binaries(
+            unsigned,
             "/usr/share/ovmf/PkKek-1-snakeoil.key",
             "/usr/share/ovmf/PkKek-1-snakeoil.pem",
             "snakeoil",
         )
-        iso = GrubShellBootableIsoImage('X64', shim.path, grub.path)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'x64', True)
+        # The signed binaries are only needed until they are on the media
+        with shim, grub:
+            media = self.add_grub_shell_media(
+                q, 'X64', shim.path, grub.path
+            )
+        with media:
+            self.run_qemu_check_secure_boot(q, 'x64', True)
 
     @unittest.skipUnless(DPKG_ARCH == 'amd64', "amd64-only")
     def test_ovmf_snakeoil_secure_boot_unsigned(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF_Q35,
             variant=QemuEfiVariant.SNAKEOIL,
             flash_size=QemuEfiFlashSize.DEFAULT,
         )
         grub = get_local_grub_path('X64', signed=False)
         shim = get_local_shim_path('X64', signed=False)
-        iso = GrubShellBootableIsoImage('X64', shim, grub)
-        q.add_disk(iso.path)
-        self.run_cmd_check_secure_boot(q.command, 'x64', False)
+        with self.add_grub_shell_media(q, 'X64', shim, grub):
+            self.run_qemu_check_secure_boot(q, 'x64', False)
 
     def test_ovmf32_4m_secboot(self):
-        q = Qemu.QemuCommand(
+        q = self.qemu_command(
             QemuEfiMachine.OVMF32,
             variant=QemuEfiVariant.SECBOOT,
             flash_size=QemuEfiFlashSize.SIZE_4MB,
         )
-        self.run_cmd_check_shell(q.command)
+        self.run_qemu_check_shell(q)
 
     def test_riscv64(self):
-        q = Qemu.QemuCommand(QemuEfiMachine.RISCV64)
-        self.run_cmd_check_shell(q.command)
+        q = self.qemu_command(QemuEfiMachine.RISCV64)
+        self.run_qemu_check_shell(q)
+
+
+def run_parallel(test_names, jobs):
+    '''
+    Run each test in its own interpreter, at most jobs at a time. Every
+    test spawns a single QEMU instance, so this also bounds the number of
+    concurrent QEMU processes. Output of each test is collected and only
+    printed once the test has finished, so logs never interleave.
+    '''
+    def run_one(test_name):
+        # Tell the child to run its single test itself rather than fanning
+        # out again, and how many run next to it
+        proc = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__), '--jobs', '1',
+                f'{BootToShellTest.__name__}.{test_name}',
+            ],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            encoding='UTF-8', errors='replace',
+            env=dict(os.environ, SHELL_TEST_JOBS=str(jobs)),
+        )
+        return (test_name, proc.returncode, proc.stdout)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_one, name) for name in test_names]
+        for future in concurrent.futures.as_completed(futures):
+            (test_name, returncode, output) = future.result()
+            status = 'ok' if returncode == 0 else 'FAIL'
+            sys.stdout.write(f"===== {test_name} =====\n")
+            sys.stdout.write(output)
+            sys.stdout.write(f"===== {test_name} ... {status} =====\n")
+            sys.stdout.flush()
+            if returncode != 0:
+                failed.append(test_name)
+
+    sys.stdout.write(
+        "Ran %d tests with %d jobs, %d failed\n" %
+        (len(test_names), jobs, len(failed))
+    )
+    for test_name in sorted(failed):
+        sys.stdout.write(f"FAIL: {test_name}\n")
+    return len(failed) == 0
+
 
 if __name__ == '__main__':
-    unittest.main(verbosity=2)
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        default=int(os.environ.get('SHELL_TEST_JOBS', '1')),
+        help='number of tests to run in parallel (0: one per CPU)',
+    )
+    (args, unittest_args) = parser.parse_known_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if jobs == 1:
+        unittest.main(argv=[sys.argv[0]] + unittest_args, verbosity=2)
+
+    # In parallel mode the children run one test each, so only test names
+    # make sense here
+    test_names = unittest.TestLoader().getTestCaseNames(BootToShellTest)
+    options = [a for a in unittest_args if a.startswith('-')]
+    if options:
+        parser.error(
+            "only test names can be given with --jobs, not %s"
+            % (' '.join(options))
+        )
+    if unittest_args:
+        selected = []
+        for arg in unittest_args:
+            name = arg.removeprefix('BootToShellTest.')
+            if name not in test_names:
+                parser.error(f"no such test: {arg}")
+            if name not in selected:
+                selected.append(name)
+        test_names = selected
+    if not test_names:
+        parser.error("no tests selected")
+    sys.exit(0 if run_parallel(test_names, jobs) else 1)